@@ -1,12 +1,16 @@
-from argparse import ArgumentParser, ArgumentTypeError
+from argparse import ArgumentParser, ArgumentTypeError, REMAINDER
 from cmd import Cmd
-from datetime import datetime, timedelta
+from contextlib import redirect_stdout
+from datetime import timedelta
 from dateutil.parser import parse as parse_time
 from functools import partial
+from heapq import merge
+from itertools import groupby, islice
+from pathlib import Path
 
 import getpass
+import io
 import logging
-import shelve
 import shlex
 
 from orgmate.cli_utils import (
@@ -17,10 +21,16 @@ from orgmate.cli_utils import (
     edit_text,
     parse_duration,
 )
+from orgmate.clock import Clock
+from orgmate.dashboard import Dashboard
+from orgmate.history import History
 from orgmate.job import Job
-from orgmate.log import Log
 from orgmate.node import Node, NodeFilter
+from orgmate.snapshot import Snapshot
+from orgmate.storage import Storage
 from orgmate.task import Flow, Status, Task, NodeFilter
+from orgmate.transfer import export_jsonl, import_jsonl
+from orgmate.trie import Trie
 
 
 DEFAULT_ALIASES = {
@@ -30,6 +40,11 @@ DEFAULT_ALIASES = {
     'complete': 'set status done',
     'todo': 'find -f duration'
 }
+READ_ONLY_COMMANDS = {'EOF', 'help', 'sel', 'tree', 'find'}
+WATCH_COMMANDS = {'tree', 'find'}
+DATA_PATH = 'data'
+SNAPSHOT_PATH = 'snapshot'
+COMPLETION_LIMIT = 100
 
 logger = logging.getLogger(__name__)
 
@@ -40,23 +55,50 @@ def make_parser(prog):
     return result
 
 
+def _remap_node(node, tasks):
+    if node is None or node.parent.id not in tasks or node.task.id not in tasks:
+        return None
+    return Node(tasks[node.parent.id], tasks[node.task.id], node.depth)
+
+
+def _remap_job(job, tasks):
+    task = tasks.get(job.task.id) if job is not None else None
+    if task is None:
+        return None
+    key = job.time, job.cmd, job.period
+    return next((new_job for new_job in task.jobs if (new_job.time, new_job.cmd, new_job.period) == key), None)
+
+
 @add_cmd_guards
 class CLI(Cmd):
     def __init__(self, clear_state):
         super().__init__()
         self.clear_state = clear_state
-        self.aliases = DEFAULT_ALIASES
-        self.last_save = datetime.now()
+        self.storage = None
+        self.aliases = dict(DEFAULT_ALIASES)
+        self.last_save = Clock.current.now()
+
+    @property
+    def aliases(self):
+        return self._aliases
+
+    @aliases.setter
+    def aliases(self, value):
+        self._aliases = value
+        self.alias_index = Trie(value)
 
     def _select_task(self, task):
         self.task = task
-        self.prompt = f'{datetime.now():%Y-%m-%d %H:%M}, {task.name} > '
+        self.prompt = f'{Clock.current.now():%Y-%m-%d %H:%M}, {task.name} > '
 
     def _get_node(self, idx):
         try:
-            return self.last_nodes[idx - 1]
+            node = self.last_nodes[idx - 1]
         except IndexError:
             raise NodeIndexError
+        if node is None:
+            raise NodeIndexError
+        return node
 
     def _get_task(self, node_index, default_task=None):
         if node_index is None:
@@ -66,9 +108,37 @@ class CLI(Cmd):
         return self._get_node(node_index).task
 
     def _save(self):
-        self.db['aliases'] = self.aliases
-        self.db['root'] = self.root
-        self.last_save = datetime.now()
+        self.storage.save(self.root, self.aliases)
+        self.last_save = Clock.current.now()
+
+    def _sync(self):
+        state = self.storage.sync(self.root, self.aliases)
+        if state is None:
+            return False
+        tasks, root_id, self.aliases = state
+        last_nodes, last_jobs = self.last_nodes, self.last_jobs
+        # Recorded operations refer to the tasks replaced by the merge
+        if History.clear():
+            print('Undo history was dropped after merging changes saved by another session')
+        self._set_root(tasks[root_id], tasks.values(), tasks.get(self.task.id))
+        self.last_nodes = [_remap_node(node, tasks) for node in last_nodes]
+        self.last_jobs = [_remap_job(job, tasks) for job in last_jobs]
+        return True
+
+    def _set_root(self, root, tasks, task=None):
+        self.root = root
+        self._select_task(task or root)
+        Job.init_schedule(tasks)
+        Task.init_expiry(tasks)
+        Task.init_names(tasks)
+        History.clear()
+        self.last_nodes = []
+        self.last_jobs = []
+
+    def _on_load(self, tasks):
+        Job.extend_schedule(tasks)
+        Task.extend_expiry(tasks)
+        Task.extend_names(tasks)
 
     def _print_last_nodes(self, args):
         table = Table(2 + len(args.field))
@@ -80,50 +150,76 @@ class CLI(Cmd):
         table.print()
 
     def preloop(self):
-        self.db = shelve.open('data')
-        if not self.clear_state and 'root' in self.db:
-            self.root = self.db['root']
-            self.aliases = self.db['aliases']
+        self.storage = Storage(DATA_PATH, SNAPSHOT_PATH)
+        self.storage.on_load = self._on_load
+        state = self.storage.load()
+        if state is not None and not self.clear_state:
+            tasks, root_id, self.aliases = state
+            self._set_root(tasks[root_id], tasks.values())
         else:
-            self.root = Task(getpass.getuser())
-        self.root.clear_obsolete()
-        self._select_task(self.root)
-        Job.init_schedule(self.root)
-        self.last_nodes = []
-        self.last_jobs = []
+            root = Task(getpass.getuser())
+            self._set_root(root, [root])
+        Task.clear_obsolete()
 
     def precmd(self, line):
+        self._sync()
+        self.storage.load_due(Clock.current.now())
+        Task.clear_obsolete()
         current_task = self.task
         for job in Job.iter_pending():
+            if not self.storage.claim(job.task.id, job.time, job.cmd):
+                logger.debug('Skipping %s run by another session', job)
+                continue
             logger.debug('Running %s', job)
-            Log.current_time = job.time
-            self._select_task(job.task)
-            self.onecmd(job.cmd)
-        else:
-            Log.current_time = None
-            self._select_task(current_task)
+            with Clock.current.at(job.time):
+                self._select_task(job.task)
+                self.onecmd(job.cmd)
+        self._select_task(current_task)
         return line
 
     def postcmd(self, stop, line):
-        if stop or timedelta(minutes=5) < datetime.now() - self.last_save:
+        if stop or timedelta(minutes=5) < Clock.current.now() - self.last_save:
             self._save()
         return stop
 
     def postloop(self):
-        self.db.close()
+        self.storage.flush()
+        while self._sync():
+            self.storage.flush()
+        self.storage.close()
+
+    def close(self):
+        # Saves queued before an error or an interrupt are still written
+        if self.storage is not None:
+            self.storage.close()
+
+    def onecmd(self, line):
+        with History.transaction():
+            return super().onecmd(line)
 
     def emptyline(self):
         return self.onecmd('todo')
 
     def default(self, line):
-        for key, val in self.aliases.items():
-            if line.startswith(key):
-                return self.onecmd(val + line.removeprefix(key))
+        key = self.alias_index.longest_prefix(line)
+        if key is not None:
+            return self.onecmd(self.aliases[key] + line.removeprefix(key))
         super().default(line)
 
     def completenames(self, text, *ignored):
-        aliases = [key for key in self.aliases if key.startswith(text)]
-        return super().completenames(text, *ignored) + aliases
+        aliases = islice(self.alias_index.iter_keys(text), COMPLETION_LIMIT)
+        return super().completenames(text, *ignored) + list(aliases)
+
+    def _iter_names(self, prefix):
+        names = merge(Task.iter_names(prefix), self.storage.pending_names.iter_keys(prefix))
+        return (name for name, _ in groupby(names))
+
+    def completedefault(self, text, *ignored):
+        if text.isdigit():
+            indices = (str(idx) for idx in range(1, len(self.last_nodes) + 1))
+            return list(islice((idx for idx in indices if idx.startswith(text)), COMPLETION_LIMIT))
+        # Names with spaces are completed as one argument
+        return [shlex.quote(name) for name in islice(self._iter_names(text), COMPLETION_LIMIT)]
 
     def do_EOF(self, _):
         'Exit OrgMate'
@@ -133,6 +229,28 @@ class CLI(Cmd):
         'Save current state'
         self._save()
 
+    def make_undo_parser(self):
+        result = ArgumentParser(prog='undo')
+        result.add_argument('count', type=int, nargs='?', default=1)
+        return result
+
+    def do_undo(self, args):
+        for _ in range(args.count):
+            if not History.undo():
+                print('Nothing to undo')
+                break
+
+    def make_redo_parser(self):
+        result = ArgumentParser(prog='redo')
+        result.add_argument('count', type=int, nargs='?', default=1)
+        return result
+
+    def do_redo(self, args):
+        for _ in range(args.count):
+            if not History.redo():
+                print('Nothing to redo')
+                break
+
     make_sel_parser = lambda _: make_parser('sel')
 
     def do_sel(self, args):
@@ -170,11 +288,14 @@ class CLI(Cmd):
         result.add_argument('node_index', type=int, nargs='?')
         return result
 
+    def _walk_tree(self, task, args):
+        node_filter = NodeFilter(max_depth=args.depth, skip_done=not args.all, skip_seen=False)
+        return task.iter_subtasks(node_filter, 0)
+
     def do_tree(self, args):
         task = self._get_task(args.node_index)
         self.last_nodes.clear()
-        node_filter = NodeFilter(max_depth=args.depth, skip_done=not args.all, skip_seen=False)
-        self.last_nodes = list(task.iter_subtasks(node_filter, 0))
+        self.last_nodes = list(self._walk_tree(task, args))
         self._print_last_nodes(args)
 
     def make_find_parser(self):
@@ -185,15 +306,64 @@ class CLI(Cmd):
         result.add_argument('keyword', type=str.lower, nargs='?')
         return result
 
+    def _walk_find(self, task, args):
+        node_filter = NodeFilter(skip_done=not args.all, skip_seen=True)
+        check = (lambda t: args.keyword in t.name.lower()) if args.keyword else (lambda t: t.is_relevant())
+        nodes = [n for n in task.iter_subtasks(node_filter) if check(n.task)]
+        nodes.sort(key=lambda n: n.task.priority, reverse=True)
+        return nodes
+
     def do_find(self, args):
         task = self._get_task(args.node)
         self.last_nodes.clear()
-        node_filter = NodeFilter(skip_done=not args.all, skip_seen=True)
-        check = (lambda t: args.keyword in t.name.lower()) if args.keyword else (lambda t: t.is_relevant())
-        self.last_nodes = [n for n in task.iter_subtasks(node_filter) if check(n.task)]
-        self.last_nodes.sort(key=lambda n: n.task.priority, reverse=True)
+        self.last_nodes = self._walk_find(task, args)
         self._print_last_nodes(args)
 
+    def make_watch_parser(self):
+        result = ArgumentParser(prog='watch')
+        result.add_argument('-i', '--interval', type=float, default=1.0)
+        result.add_argument('command', nargs=REMAINDER)
+        return result
+
+    def do_watch(self, args):
+        cmd, arg, line = self.parseline(shlex.join(args.command) or 'todo')
+        key = self.alias_index.longest_prefix(line)
+        if cmd not in WATCH_COMMANDS and key is not None:
+            cmd, arg, line = self.parseline(self.aliases[key] + line.removeprefix(key))
+        if cmd not in WATCH_COMMANDS:
+            print('Only tree and find views can be watched')
+            return
+        try:
+            view_args = getattr(self, f'make_{cmd}_parser')().parse_args(shlex.split(arg))
+        except SystemExit:
+            return
+        task = self._get_task(view_args.node_index if cmd == 'tree' else view_args.node)
+        walk = getattr(self, f'_walk_{cmd}')
+        dashboard = Dashboard(lambda: walk(self.storage.tasks.get(task.id, task), view_args), view_args.field)
+        Task.observe(dashboard.notify)
+        dashboard.start()
+        try:
+            while True:
+                root = self.root
+                # Jobs and expiry get their own undo entries, as they do between commands
+                with redirect_stdout(io.StringIO()), History.suspend():
+                    self.precmd('')
+                    self.postcmd(False, '')
+                if self.root is not root:
+                    dashboard.reshaped = True
+                dashboard.update(f'{Clock.current.now():%Y-%m-%d %H:%M:%S}, {line}')
+                timeout = args.interval
+                next_time = Job.get_next_time()
+                if next_time is not None:
+                    timeout = min(timeout, (next_time - Clock.current.now()).total_seconds())
+                Clock.current.sleep(max(timeout, 0))
+        except KeyboardInterrupt:
+            pass
+        finally:
+            Task.unobserve(dashboard.notify)
+            dashboard.stop()
+        self.last_nodes = dashboard.nodes
+
     def make_rm_parser(self):
         result = ArgumentParser(prog='rm')
         result.add_argument('node_index', type=int, nargs='+')
@@ -289,15 +459,20 @@ class CLI(Cmd):
             table.add_row(attr.capitalize(), getattr(node, attr))
         next_statuses = ', '.join(str(status) for status in task.get_next_statuses())
         table.add_row('Next statuses', next_statuses or '-')
+        for status in (Status.ACTIVE, Status.INACTIVE):
+            seconds = task.log.get_total_time(status).total_seconds()
+            table.add_row(f'{status} time', timedelta(seconds=round(seconds)))
         table.print()
 
     make_log_parser = lambda _: make_parser('log')
 
     def do_log(self, args):
         task = self._get_task(args.node_index)
-        table = Table(2)
+        table = Table(3)
+        for rollup in task.log.rollups:
+            table.add_row(rollup.start, f'{Status.ACTIVE} {rollup.active}', f'{Status.INACTIVE} {rollup.inactive}')
         for item in task.log.items:
-            table.add_row(item.status, item.timestamp)
+            table.add_row(item.status, item.timestamp, '')
         table.print()
 
     def make_alias_parser(self):
@@ -320,12 +495,15 @@ class CLI(Cmd):
                     table.add_row(key, value)
                 table.print()
             case 'add':
+                if args.key not in self.aliases:
+                    self.alias_index.add(args.key)
                 self.aliases[args.key] = args.value
             case 'rm':
                 for key in args.key:
-                    self.aliases.pop(key, None)
+                    if self.aliases.pop(key, None) is not None:
+                        self.alias_index.remove(key)
             case 'restore':
-                self.aliases = DEFAULT_ALIASES
+                self.aliases = dict(DEFAULT_ALIASES)
 
     def make_sked_parser(self):
         result = ArgumentParser(prog='sked')
@@ -353,7 +531,10 @@ class CLI(Cmd):
                 Job(task, args.time, args.cmd, args.period).add()
             case 'rm':
                 for idx in args.job_index:
-                    self.last_jobs[idx - 1].remove()
+                    job = self.last_jobs[idx - 1]
+                    if job is None:
+                        raise NodeIndexError
+                    job.remove()
 
     def make_note_parser(self):
         result = make_parser('note')
@@ -366,3 +547,95 @@ class CLI(Cmd):
             task.note = edit_text(task.note)
         else:
             print(task.note, end='')
+
+    def make_export_parser(self):
+        result = ArgumentParser(prog='export')
+        result.add_argument('-n', '--node', type=int)
+        result.add_argument('path', type=lambda p: Path(p).expanduser())
+        return result
+
+    def do_export(self, args):
+        task = self._get_task(args.node, self.root)
+        try:
+            with open(args.path, 'w') as f:
+                export_jsonl(task, f)
+        except OSError as e:
+            print(f'Failed to export to {args.path}: {e}')
+
+    def make_import_parser(self):
+        result = ArgumentParser(prog='import')
+        result.add_argument('path', type=lambda p: Path(p).expanduser())
+        return result
+
+    def do_import(self, args):
+        try:
+            with open(args.path) as f:
+                root = import_jsonl(f)
+        except OSError as e:
+            print(f'Failed to import {args.path}: {e}')
+            return
+        except (ValueError, KeyError, TypeError) as e:
+            print(f'Invalid import file {args.path}: {e!r}')
+            return
+        tasks = [root] + [node.task for node in root.iter_subtasks()]
+        # Only a full export of this tree replaces it, other exports are added to the current task
+        if root.id == self.root.id or not self.root.subtasks:
+            self.storage.replace(root)
+            self._set_root(root, tasks)
+            return
+        known = {self.root.id} | {node.task.id for node in self.root.iter_subtasks()}
+        if any(task.id in known for task in tasks):
+            print(f'Tasks of {args.path} already exist, export the whole tree to restore it')
+            return
+        self.task.link(root, len(self.task.subtasks), 0)
+        self.task.refresh()
+        Job.extend_schedule(tasks)
+        Task.extend_expiry(tasks)
+
+
+class ReadOnlyCLI(CLI):
+    def __init__(self):
+        super().__init__(clear_state=False)
+
+    def get_names(self):
+        return [name for name in super().get_names() if name.split('_', 1)[-1] in READ_ONLY_COMMANDS]
+
+    def preloop(self):
+        try:
+            self.snapshot = Snapshot(SNAPSHOT_PATH)
+        except (FileNotFoundError, NotADirectoryError):
+            logger.info('No snapshot found, reading saved state instead')
+            self.snapshot = None
+            super().preloop()
+            return
+        self.root = self.snapshot.root
+        self.aliases = self.snapshot.aliases
+        self.names = None
+        self._select_task(self.root)
+        self.last_nodes = []
+
+    def _iter_names(self, prefix):
+        if self.snapshot is None:
+            return super()._iter_names(prefix)
+        if self.names is None:
+            self.names = Trie(self.snapshot.iter_names())
+        return self.names.iter_keys(prefix)
+
+    def precmd(self, line):
+        return line
+
+    def postcmd(self, stop, line):
+        return stop
+
+    def postloop(self):
+        if self.snapshot is None:
+            self.storage.close()
+        else:
+            self.snapshot.close()
+
+    def onecmd(self, line):
+        cmd, *_ = self.parseline(line)
+        if cmd not in READ_ONLY_COMMANDS and hasattr(self, f'do_{cmd}'):
+            print('Command is not available in read-only mode')
+            return
+        return super().onecmd(line)
@@ -41,16 +41,28 @@ class Table:
         self.cols = [Column() for _ in range(col_count)]
         self.rows = []
 
-    def add_row(self, *row):
+    def _fit(self, row):
         row = [str(field) for field in row]
         for field, col in zip(row, self.cols):
             col.width = max(col.width, len(field))
-        self.rows.append(row)
+        return row
+
+    def add_row(self, *row):
+        self.rows.append(self._fit(row))
+
+    def set_row(self, idx, *row):
+        self.rows[idx] = self._fit(row)
+
+    def get_template(self):
+        return ' '.join(col.get_template() for col in self.cols)
+
+    def format(self):
+        template = self.get_template()
+        return [template.format(*row) for row in self.rows]
 
     def print(self, file=None):
-        template = ' '.join(col.get_template() for col in self.cols)
-        for row in self.rows:
-            print(template.format(*row), file=file)
+        for line in self.format():
+            print(line, file=file)
         self.rows.clear()
 
 
@@ -111,3 +123,10 @@ def parse_duration(duration_str):
     match = DURATION_REGEX.search(duration_str)
     kwargs = {key: int(value) for key, value in match.groupdict('0').items()}
     return timedelta(**kwargs)
+
+
+def parse_period(duration_str):
+    result = parse_duration(duration_str)
+    if result <= timedelta():
+        raise ArgumentTypeError(f'invalid period: {duration_str!r}')
+    return result
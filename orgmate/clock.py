@@ -0,0 +1,34 @@
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+import time
+
+
+class Clock:
+    current = None
+
+    def __init__(self, time=None):
+        self.time = time
+
+    def now(self):
+        return datetime.now() if self.time is None else self.time
+
+    def sleep(self, seconds):
+        if self.time is None:
+            time.sleep(seconds)
+        else:
+            self.advance(timedelta(seconds=seconds))
+
+    def advance(self, delta):
+        self.time = self.now() + delta
+
+    @contextmanager
+    def at(self, time):
+        saved, self.time = self.time, time
+        try:
+            yield
+        finally:
+            self.time = saved
+
+
+Clock.current = Clock()
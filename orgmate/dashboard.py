@@ -0,0 +1,88 @@
+from collections import defaultdict
+from itertools import islice
+
+import shutil
+import sys
+
+from orgmate.cli_utils import Table
+
+
+CLEAR_SCREEN = '\033[2J'
+CLEAR_LINE = '\033[K'
+MOVE_CURSOR = '\033[{};1H'
+HEADER_HEIGHT = 1
+
+
+class Dashboard:
+    def __init__(self, walk, fields, file=None):
+        self.walk = walk
+        self.fields = fields
+        self.file = file or sys.stdout
+        self.table = None
+        self.nodes = []
+        self.rows = {}
+        self.lines = []
+        self.dirty = set()
+        self.reshaped = True
+
+    def notify(self, task, reshaped):
+        if reshaped:
+            self.reshaped = True
+        elif task in self.rows:
+            self.dirty.add(task)
+
+    def _make_row(self, idx):
+        node = self.nodes[idx]
+        return idx + 1, node.name, *(getattr(node, field) for field in self.fields)
+
+    def _layout(self):
+        height = shutil.get_terminal_size().lines - HEADER_HEIGHT - 1
+        self.nodes = list(islice(self.walk(), max(height, 0)))
+        self.rows = defaultdict(list)
+        self.table = Table(2 + len(self.fields))
+        self.table.cols[0].align = '>'
+        for idx, node in enumerate(self.nodes):
+            self.rows[node.task].append(idx)
+            self.table.add_row(*self._make_row(idx))
+        self.reshaped = False
+        self.dirty.clear()
+        return self.table.format()
+
+    def _update_rows(self):
+        if 'duration' in self.fields:
+            changed = range(len(self.nodes))
+        else:
+            changed = sorted(idx for task in self.dirty for idx in self.rows[task])
+        self.dirty.clear()
+        widths = [col.width for col in self.table.cols]
+        for idx in changed:
+            self.table.set_row(idx, *self._make_row(idx))
+        if widths != [col.width for col in self.table.cols]:
+            return self.table.format()
+        template = self.table.get_template()
+        lines = self.lines.copy()
+        for idx in changed:
+            lines[idx] = template.format(*self.table.rows[idx])
+        return lines
+
+    def _write(self, *chunks):
+        self.file.write(''.join(chunks))
+        self.file.flush()
+
+    def start(self):
+        self.lines = []
+        self._write(CLEAR_SCREEN)
+
+    def update(self, header):
+        lines = self._layout() if self.reshaped else self._update_rows()
+        chunks = [MOVE_CURSOR.format(1), header, CLEAR_LINE]
+        for idx, line in enumerate(lines):
+            if idx >= len(self.lines) or line != self.lines[idx]:
+                chunks += [MOVE_CURSOR.format(HEADER_HEIGHT + idx + 1), line, CLEAR_LINE]
+        for idx in range(len(lines), len(self.lines)):
+            chunks += [MOVE_CURSOR.format(HEADER_HEIGHT + idx + 1), CLEAR_LINE]
+        self.lines = lines
+        self._write(*chunks)
+
+    def stop(self):
+        self._write(MOVE_CURSOR.format(HEADER_HEIGHT + len(self.lines) + 1))
@@ -0,0 +1,88 @@
+from contextlib import contextmanager
+
+
+HISTORY_SIZE = 100
+
+
+class History:
+    _undo = []
+    _redo = []
+    _ops = None
+
+    @classmethod
+    def record(cls, task, func, *args):
+        if cls._ops is not None:
+            cls._ops.append((task, func, args))
+
+    @classmethod
+    def touch(cls, task):
+        cls.record(task, None)
+
+    @classmethod
+    @contextmanager
+    def transaction(cls, automatic=False):
+        if cls._ops is not None:
+            yield
+            return
+        cls._ops = []
+        try:
+            yield
+        finally:
+            ops, cls._ops = cls._ops, None
+            if ops:
+                cls._undo.append((automatic, ops))
+                del cls._undo[:-HISTORY_SIZE]
+                cls._redo.clear()
+
+    @classmethod
+    @contextmanager
+    def suspend(cls):
+        ops, cls._ops = cls._ops, None
+        try:
+            yield
+        finally:
+            cls._ops = ops
+
+    @classmethod
+    def clear(cls):
+        dropped = bool(cls._undo or cls._redo)
+        cls._undo.clear()
+        cls._redo.clear()
+        cls._ops = None
+        return dropped
+
+    @classmethod
+    def _replay(cls, source, target):
+        if not source:
+            return False
+        automatic, ops = source.pop()
+        cls._ops, touched = [], {}
+        for task, func, args in reversed(ops):
+            if func is None:
+                cls.touch(task)
+            else:
+                func(*args)
+            if task is not None:
+                touched[task] = None
+        for task in touched:
+            task.refresh()
+        target.append((automatic, cls._ops))
+        cls._ops = None
+        return True
+
+    @classmethod
+    def undo(cls):
+        # Automatic changes such as expiry are undone along with the command before them
+        if all(automatic for automatic, _ in cls._undo):
+            return False
+        while cls._undo[-1][0]:
+            cls._replay(cls._undo, cls._redo)
+        return cls._replay(cls._undo, cls._redo)
+
+    @classmethod
+    def redo(cls):
+        if not cls._replay(cls._redo, cls._undo):
+            return False
+        while cls._redo and cls._redo[-1][0]:
+            cls._replay(cls._redo, cls._undo)
+        return True
@@ -1,20 +1,37 @@
-from datetime import datetime
 from heapq import heapify, heappush, heappop
 
+from orgmate.clock import Clock
+from orgmate.history import History
+
 
 class Job:
     _schedule = []
 
     @classmethod
-    def init_schedule(cls, root):
-        for node in root.iter_subtasks():
-            cls._schedule.extend(node.task.jobs)
-        heapify(cls._schedule)        
+    def init_schedule(cls, tasks):
+        for job in cls._schedule:
+            job.scheduled = False
+        cls._schedule.clear()
+        cls.extend_schedule(tasks)
+
+    @classmethod
+    def extend_schedule(cls, tasks):
+        for task in tasks:
+            for job in task.jobs:
+                if not job.scheduled:
+                    job.scheduled = True
+                    cls._schedule.append(job)
+        heapify(cls._schedule)
+
+    @classmethod
+    def get_next_time(cls):
+        return cls._schedule[0].time if cls._schedule else None
 
     @classmethod
     def iter_pending(cls):
-        while cls._schedule and cls._schedule[0].time < datetime.now():
+        while cls._schedule and cls._schedule[0].time <= Clock.current.now():
             job = heappop(cls._schedule)
+            job.scheduled = False
             if not job.remove():
                 continue
             yield job
@@ -27,6 +44,7 @@ class Job:
         self.time = time
         self.cmd = cmd
         self.period = period
+        self.scheduled = False
 
     def __lt__(self, other):
         return self.time < other.time
@@ -34,13 +52,22 @@ class Job:
     def __repr__(self):
         return f'Job(task={self.task}, time={self.time}, cmd={self.cmd}, period={self.period})'
 
-    def add(self):
-        self.task.jobs.append(self)
-        heappush(self._schedule, self)
+    def add(self, index=None):
+        jobs = self.task.jobs
+        jobs.insert(len(jobs) if index is None else index, self)
+        self.task.record = None
+        # Removed jobs stay in the schedule until they are due, undo only brings them back
+        if not self.scheduled:
+            self.scheduled = True
+            heappush(self._schedule, self)
+        History.record(self.task, self.remove)
 
     def remove(self):
         jobs = self.task.jobs
         if self in jobs:
-            jobs.remove(self)
+            index = jobs.index(self)
+            del jobs[index]
+            self.task.record = None
+            History.record(self.task, self.add, index)
             return True
         return False
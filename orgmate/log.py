@@ -1,36 +1,127 @@
-from dataclasses import dataclass
+from dataclasses import dataclass, replace
 from datetime import datetime, timedelta
 
+from orgmate.clock import Clock
+from orgmate.history import History
 from orgmate.status import Status
 
 
 FINISHED_TASK_TTL = timedelta(days=90)
+LOG_RETENTION = timedelta(days=30)
+ROLLUP_PERIOD = timedelta(days=1)
+ROLLUP_EPOCH = datetime(2000, 1, 3)
+WEEKLY_ROLLUP_AGE = timedelta(weeks=4)
+MONTHLY_ROLLUP_AGE = timedelta(days=365)
+WEEK = timedelta(weeks=1)
+
+
+def _get_coarse_start(start, age):
+    if age >= MONTHLY_ROLLUP_AGE:
+        return start.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    if age >= WEEKLY_ROLLUP_AGE:
+        return ROLLUP_EPOCH + (start - ROLLUP_EPOCH) // WEEK * WEEK
+    return start
 
 
 class Log:
-    current_time = None
+    retention = LOG_RETENTION
+    rollup_period = ROLLUP_PERIOD
 
     @dataclass
     class Item:
         status: Status
         timestamp: datetime
 
+    @dataclass
+    class Rollup:
+        start: datetime
+        active: timedelta = timedelta()
+        inactive: timedelta = timedelta()
+
     def __init__(self):
-        self.items = []
-        self.set_status(Status.NEW)
+        self.items = [Log.Item(Status.NEW, Clock.current.now())]
+        self.rollups = []
+
+    def __setstate__(self, state):
+        state.setdefault('rollups', [])
+        self.__dict__.update(state)
 
     def get_status(self):
         return self.items[-1].status
 
     def get_duration(self):
-        return datetime.now() - self.items[-1].timestamp
+        return Clock.current.now() - self.items[-1].timestamp
+
+    def get_total_time(self, status):
+        result = sum((getattr(rollup, status.name.lower()) for rollup in self.rollups), timedelta())
+        timestamps = [item.timestamp for item in self.items[1:]] + [Clock.current.now()]
+        for item, end in zip(self.items, timestamps):
+            if item.status == status:
+                result += end - item.timestamp
+        return result
 
     def set_status(self, status):
         if self.items and self.get_status() == status:
-            return
-        timestamp = datetime.now() if self.current_time is None else self.current_time
-        item = Log.Item(status, timestamp)
+            return False
+        timestamp = Clock.current.now()
+        self._push(Log.Item(status, timestamp))
+        if self.items[0].timestamp < timestamp - self.retention - self.rollup_period:
+            self.compact(timestamp - self.retention)
+        return True
+
+    def _push(self, item):
         self.items.append(item)
+        History.record(None, self._pop)
+
+    def _pop(self):
+        History.record(None, self._push, self.items.pop())
+
+    def _splice(self, items, count, start, rollups):
+        History.record(None, self._splice, self.items[:count], len(items), start, self.rollups[start:])
+        self.items[:count] = items
+        self.rollups[start:] = rollups
+
+    def compact(self, cutoff):
+        rollups = self.rollups
+        self.rollups = rollups[:-1] + [replace(rollup) for rollup in rollups[-1:]]
+        count = 0
+        while count + 1 < len(self.items) and self.items[count].timestamp < cutoff:
+            item, next_item = self.items[count], self.items[count + 1]
+            self._roll_up(item.status, item.timestamp, next_item.timestamp)
+            count += 1
+        self._coarsen(cutoff)
+        History.record(None, self._splice, self.items[:count], 0, 0, rollups)
+        del self.items[:count]
+
+    def _coarsen(self, cutoff):
+        rollups = []
+        for rollup in self.rollups:
+            start = _get_coarse_start(rollup.start, cutoff - rollup.start)
+            if rollups and rollups[-1].start == start:
+                last = rollups[-1]
+                rollups[-1] = Log.Rollup(start, last.active + rollup.active, last.inactive + rollup.inactive)
+            elif start != rollup.start:
+                rollups.append(Log.Rollup(start, rollup.active, rollup.inactive))
+            else:
+                rollups.append(rollup)
+        self.rollups = rollups
+
+    def _roll_up(self, status, start, end):
+        if status not in (Status.ACTIVE, Status.INACTIVE):
+            return
+        while start < end:
+            period_start = ROLLUP_EPOCH + (start - ROLLUP_EPOCH) // self.rollup_period * self.rollup_period
+            period_end = min(end, period_start + self.rollup_period)
+            if not self.rollups or self.rollups[-1].start != period_start:
+                self.rollups.append(Log.Rollup(period_start))
+            rollup = self.rollups[-1]
+            if status == Status.ACTIVE:
+                rollup.active += period_end - start
+            else:
+                rollup.inactive += period_end - start
+            start = period_end
 
-    def is_obsolete(self):
-        return self.get_status() == Status.DONE and self.get_duration() > FINISHED_TASK_TTL
+    def get_expiry_time(self):
+        if self.get_status() != Status.DONE:
+            return None
+        return self.items[-1].timestamp + FINISHED_TASK_TTL
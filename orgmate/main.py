@@ -1,10 +1,13 @@
-from argparse import ArgumentParser
+from argparse import ArgumentParser, REMAINDER
 from pathlib import Path
 
 import logging
 import os
+import shlex
 
-from orgmate.cli import CLI
+from orgmate.cli import CLI, ReadOnlyCLI
+from orgmate.cli_utils import parse_duration, parse_period
+from orgmate.log import Log
 
 
 logger = logging.getLogger(__name__)
@@ -16,6 +19,10 @@ def parse_args():
     parser.add_argument('-d', '--dir', default=default_dir)
     parser.add_argument('-c', '--clear-state', action='store_true')
     parser.add_argument('-v', '--verbose', action='store_true')
+    parser.add_argument('-r', '--read-only', action='store_true')
+    parser.add_argument('--log-retention', type=parse_duration, default=Log.retention)
+    parser.add_argument('--rollup-period', type=parse_period, default=Log.rollup_period)
+    parser.add_argument('command', nargs=REMAINDER)
     return parser.parse_args()
 
 
@@ -26,7 +33,20 @@ def main():
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
     os.chdir(dir)
     logger.debug('Current working directory is %s', dir)
-    CLI(args.clear_state).cmdloop()
+    Log.retention = args.log_retention
+    Log.rollup_period = args.rollup_period
+    cli = ReadOnlyCLI() if args.read_only else CLI(args.clear_state)
+    try:
+        if args.command:
+            cli.preloop()
+            line = cli.precmd(shlex.join(args.command))
+            cli.onecmd(line)
+            cli.postcmd(True, line)
+            cli.postloop()
+        else:
+            cli.cmdloop()
+    finally:
+        cli.close()
 
 
 if __name__ == '__main__':
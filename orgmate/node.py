@@ -21,7 +21,7 @@ class Node:
     @property
     def name(self):
         indent = ' ' * self.depth * self.INDENT_WIDTH if self.depth else ''
-        suffix = '/' if self.task.subtasks else ''
+        suffix = '/' if self.task.has_subtasks() else ''
         esc_color = STATUS_ESC_COLORS[self.task.status]
         return f'{indent}{esc_color}{self.task.name}{suffix}{self.ESC_RESET}'
 
@@ -43,8 +43,8 @@ class Node:
         self.parent.refresh()
 
     def remove(self):
-        self.parent.subtasks.remove(self.task)
-        self.task.parents.remove(self.parent)
+        index = self.parent.subtasks.index(self.task)
+        self.parent.unlink(self.task, index, self.task.parents.index(self.parent))
         self.parent.refresh()
 
 
@@ -55,8 +55,11 @@ class NodeFilter:
         self.skip_seen = skip_seen
         self.seen = set()
 
+    def check_depth(self, depth):
+        return self.max_depth is None or depth is None or depth < self.max_depth
+
     def check(self, node):
-        if self.max_depth is not None and self.max_depth <= node.depth:
+        if not self.check_depth(node.depth):
             return False
         if self.skip_done and node.task.status == Status.DONE:
             return False
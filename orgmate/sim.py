@@ -0,0 +1,141 @@
+from argparse import ArgumentParser
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from tempfile import TemporaryDirectory
+
+import logging
+import math
+import os
+import random
+import time
+
+from orgmate.cli import CLI
+from orgmate.cli_utils import Table, parse_duration
+from orgmate.clock import Clock
+from orgmate.job import Job
+from orgmate.task import Flow, Task
+
+
+START_TIME = datetime(2024, 1, 1)
+JOB_COMMANDS = ('set -f status active', 'set -f status inactive')
+DONE_COMMAND = 'set -f status done'
+
+
+class Stats:
+    def __init__(self):
+        self.samples = defaultdict(list)
+
+    @contextmanager
+    def measure(self, name):
+        start = time.perf_counter()
+        yield
+        self.samples[name].append(time.perf_counter() - start)
+
+    def print(self):
+        table = Table(6)
+        table.add_row('Operation', 'Count', 'Ops/s', 'Mean ms', 'P99 ms', 'Max ms')
+        for name, samples in self.samples.items():
+            total = sum(samples)
+            samples = sorted(samples)
+            table.add_row(
+                name,
+                len(samples),
+                f'{len(samples) / total:.0f}' if total else '-',
+                f'{1000 * total / len(samples):.3f}',
+                f'{1000 * samples[math.ceil(0.99 * len(samples)) - 1]:.3f}',
+                f'{1000 * samples[-1]:.3f}',
+            )
+        table.print()
+
+
+def parse_args():
+    parser = ArgumentParser(prog='python -m orgmate.sim')
+    parser.add_argument('-n', '--tasks', type=int, default=100000)
+    parser.add_argument('-f', '--fanout', type=int, default=10)
+    parser.add_argument('-j', '--jobs', type=int, default=200)
+    parser.add_argument('-d', '--days', type=int, default=90)
+    parser.add_argument('--step', type=parse_duration, default=timedelta(hours=1))
+    parser.add_argument('--save-period', type=parse_duration, default=timedelta(days=30))
+    parser.add_argument('--refresh-samples', type=int, default=10)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('-v', '--verbose', action='store_true')
+    return parser.parse_args()
+
+
+def build_tree(root, count, fanout):
+    tasks = [root]
+    for idx in range(1, count):
+        task = Task(f'task {idx}')
+        task.flow = Flow.PARALLEL
+        tasks[(idx - 1) // fanout].add(task)
+        tasks.append(task)
+    return tasks[1 + (count - 2) // fanout:]
+
+
+def schedule_jobs(leaves, count, stats, rng):
+    tasks = rng.sample(leaves, min(count, len(leaves)))
+    for task in tasks[:len(tasks) // 10]:
+        with stats.measure('schedule'):
+            Job(task, START_TIME + timedelta(days=rng.randrange(30)), DONE_COMMAND, None).add()
+    for task in tasks[len(tasks) // 10:]:
+        offset = timedelta(minutes=rng.randrange(24 * 60))
+        for idx, cmd in enumerate(JOB_COMMANDS):
+            with stats.measure('schedule'):
+                Job(task, START_TIME + offset + idx * timedelta(hours=8), cmd, timedelta(days=1)).add()
+
+
+def run(cli, clock, end_time, args, leaves, stats, rng):
+    last_save = clock.now()
+    while clock.now() < end_time:
+        clock.advance(args.step)
+        with stats.measure('expiry'):
+            cli.storage.load_due(clock.now())
+            Task.clear_obsolete()
+        pending = Job.iter_pending()
+        while True:
+            with stats.measure('schedule'):
+                job = next(pending, None)
+            if job is None:
+                break
+            with stats.measure('job'), clock.at(job.time):
+                cli._select_task(job.task)
+                cli.onecmd(job.cmd)
+        for task in rng.sample(leaves, args.refresh_samples):
+            with stats.measure('refresh'):
+                task.refresh()
+        if args.save_period <= clock.now() - last_save:
+            with stats.measure('save'):
+                cli._save()
+            with stats.measure('flush'):
+                cli.storage.flush()
+            last_save = clock.now()
+
+
+def main():
+    args = parse_args()
+    logging.basicConfig(level=logging.DEBUG if args.verbose else logging.WARNING)
+    rng = random.Random(args.seed)
+    stats = Stats()
+    clock = Clock.current = Clock(START_TIME)
+    cwd = os.getcwd()
+    with TemporaryDirectory() as dir:
+        os.chdir(dir)
+        try:
+            cli = CLI(clear_state=True)
+            cli.preloop()
+            with stats.measure('build'):
+                leaves = build_tree(cli.root, args.tasks, args.fanout)
+            schedule_jobs(leaves, args.jobs, stats, rng)
+            start = time.perf_counter()
+            run(cli, clock, START_TIME + timedelta(days=args.days), args, leaves, stats, rng)
+            elapsed = time.perf_counter() - start
+            cli.postloop()
+        finally:
+            os.chdir(cwd)
+    print(f'Simulated {args.days} days of {args.tasks} tasks in {elapsed:.2f}s')
+    stats.print()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,284 @@
+from collections import defaultdict
+from datetime import datetime
+from functools import cached_property
+from urllib.parse import quote
+
+import json
+import math
+import mmap
+import os
+import struct
+
+from orgmate.log import Log
+from orgmate.status import Status
+from orgmate.task import Flow, Task
+
+
+MAGIC = b'OMS3'
+MANIFEST_NAME = 'manifest.json'
+HEADER = struct.Struct('<4sIIIII')
+INDEX = struct.Struct('<I')
+RECORD = struct.Struct('<IIIIIIIBBBxiddd')
+EDGE = struct.Struct('<I')
+EXTERNAL = struct.Struct('<III')
+ROOT_SHARD = 'root'
+
+FLAG_AGGREGATE = 1
+FLAG_NO_WEIGHT = 2
+
+
+def _get_shard_path(path, shard_id):
+    return os.path.join(path, quote(shard_id, safe=''))
+
+
+def _replace(path, *chunks):
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'wb') as f:
+        for chunk in chunks:
+            f.write(chunk)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_NAME)) as f:
+        return json.load(f)
+
+
+def write_manifest(path, version, root_id, aliases, shards):
+    manifest = {'version': version, 'root_id': root_id, 'aliases': aliases, 'shards': shards}
+    _replace(os.path.join(path, MANIFEST_NAME), json.dumps(manifest).encode())
+    # Shards deleted since the previous manifest
+    names = {MANIFEST_NAME} | {quote(shard_id, safe='') for shard_id in shards}
+    for name in os.listdir(path):
+        if name not in names and not name.endswith('.tmp'):
+            os.remove(os.path.join(path, name))
+
+
+def get_shard_version(path, shard_id):
+    try:
+        with open(_get_shard_path(path, shard_id), 'rb') as f:
+            magic, version, *_ = HEADER.unpack(f.read(HEADER.size))
+    except (FileNotFoundError, struct.error):
+        return None
+    return version if magic == MAGIC else None
+
+
+def write_shard(path, shard_id, version, rows):
+    # Rows are (id, name, status, flow, aggregate, priority, weight, progress, timestamp, subtask ids)
+    index = {row[0]: idx for idx, row in enumerate(rows)}
+    parents = defaultdict(list)
+    for idx, row in enumerate(rows):
+        for subtask_id in row[-1]:
+            if subtask_id in index:
+                parents[subtask_id].append(idx)
+    records, edges, externals, strings = bytearray(), bytearray(), bytearray(), bytearray()
+
+    def add_string(value):
+        value = value.encode()
+        strings.extend(value)
+        return len(strings) - len(value), len(value)
+
+    for idx, (task_id, name, status, flow, aggregate, priority, weight, progress, timestamp, subtask_ids) in enumerate(rows):
+        first_edge = len(edges) // EDGE.size
+        # Subtasks of other shards are stored by id after the local tasks
+        for subtask_id in subtask_ids:
+            subtask_idx = index.get(subtask_id)
+            if subtask_idx is None:
+                subtask_idx = len(rows) + len(externals) // EXTERNAL.size
+                externals += EXTERNAL.pack(idx, *add_string(subtask_id))
+            edges += EDGE.pack(subtask_idx)
+        for parent_idx in parents[task_id]:
+            edges += EDGE.pack(parent_idx)
+        flags = FLAG_AGGREGATE * bool(aggregate) | FLAG_NO_WEIGHT * (weight is None)
+        records += RECORD.pack(
+            *add_string(task_id), *add_string(name), first_edge, len(subtask_ids), len(parents[task_id]),
+            status.value, flow.value, flags, priority,
+            weight or 0.0,
+            math.nan if progress is None else progress,
+            timestamp.timestamp(),
+        )
+    ids = b''.join(INDEX.pack(idx) for _, idx in sorted(index.items()))
+    edge_count, external_count = len(edges) // EDGE.size, len(externals) // EXTERNAL.size
+    header = HEADER.pack(MAGIC, version, len(rows), edge_count, external_count, len(strings))
+    _replace(_get_shard_path(path, shard_id), header, ids, records, edges, externals, strings)
+
+
+class Snapshot:
+    def __init__(self, path):
+        manifest = read_manifest(path)
+        self.path = path
+        self.root_id = manifest['root_id']
+        self.aliases = manifest['aliases']
+        self.peers = manifest['shards']
+        self.shards = {}
+
+    def close(self):
+        for shard in self.shards.values():
+            if shard is not None:
+                shard.close()
+        self.shards.clear()
+
+    @property
+    def root(self):
+        return self.find_task(self.root_id, [ROOT_SHARD])
+
+    def get_shard(self, shard_id):
+        if shard_id not in self.peers:
+            return None
+        if shard_id not in self.shards:
+            try:
+                self.shards[shard_id] = SnapshotShard(self, shard_id, _get_shard_path(self.path, shard_id))
+            except FileNotFoundError:
+                self.shards[shard_id] = None
+        return self.shards[shard_id]
+
+    def iter_shards(self, shard_ids):
+        for shard_id in shard_ids:
+            shard = self.get_shard(shard_id)
+            if shard is not None:
+                yield shard
+
+    def find_task(self, task_id, shard_ids):
+        for shard in self.iter_shards(dict.fromkeys([*shard_ids, ROOT_SHARD, *self.peers])):
+            task = shard.find_task(task_id)
+            if task is not None:
+                return task
+        return None
+
+    def get_external_parents(self, task, shard_id):
+        # Only heads can be linked from any shard, other tasks are linked from peers and heads
+        shard_ids = self.peers if shard_id == ROOT_SHARD else [ROOT_SHARD, *self.peers[shard_id]]
+        result = []
+        for shard in self.iter_shards(shard_ids):
+            result.extend(shard.external_parents.get(task.id, ()))
+        return result
+
+    def iter_names(self):
+        for shard in self.iter_shards(self.peers):
+            for idx in range(shard.task_count):
+                task = shard.get_task(idx)
+                if task.id != self.root_id:
+                    yield task.name
+
+
+class SnapshotShard:
+    def __init__(self, snapshot, shard_id, path):
+        with open(path, 'rb') as f:
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, _, self.task_count, edge_count, self.external_count, _ = HEADER.unpack_from(self.buf)
+        if magic != MAGIC:
+            raise ValueError(f'{path} is not an orgmate snapshot')
+        self.snapshot = snapshot
+        self.shard_id = shard_id
+        self.records_offset = HEADER.size + self.task_count * INDEX.size
+        self.edges_offset = self.records_offset + self.task_count * RECORD.size
+        self.externals_offset = self.edges_offset + edge_count * EDGE.size
+        self.strings_offset = self.externals_offset + self.external_count * EXTERNAL.size
+        self.tasks = {}
+
+    def close(self):
+        self.tasks.clear()
+        self.buf.close()
+
+    def get_string(self, offset, size):
+        offset += self.strings_offset
+        return self.buf[offset:offset + size].decode()
+
+    def get_task(self, idx):
+        task = self.tasks.get(idx)
+        if task is None:
+            task = self.tasks[idx] = SnapshotTask(self, idx)
+        return task
+
+    def find_task(self, task_id):
+        low, high = 0, self.task_count
+        while low < high:
+            middle = (low + high) // 2
+            idx, = INDEX.unpack_from(self.buf, HEADER.size + middle * INDEX.size)
+            task = self.get_task(idx)
+            if task.id == task_id:
+                return task
+            if task.id < task_id:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    def get_external(self, idx):
+        parent_idx, id_offset, id_size = EXTERNAL.unpack_from(self.buf, self.externals_offset + idx * EXTERNAL.size)
+        return parent_idx, self.get_string(id_offset, id_size)
+
+    @cached_property
+    def external_parents(self):
+        result = defaultdict(list)
+        for idx in range(self.external_count):
+            parent_idx, task_id = self.get_external(idx)
+            result[task_id].append(self.get_task(parent_idx))
+        return result
+
+    def get_tasks(self, first_edge, edge_count, shard_ids):
+        offset = self.edges_offset + first_edge * EDGE.size
+        result = []
+        for idx, in EDGE.iter_unpack(self.buf[offset:offset + edge_count * EDGE.size]):
+            if idx < self.task_count:
+                result.append(self.get_task(idx))
+                continue
+            _, task_id = self.get_external(idx - self.task_count)
+            task = self.snapshot.find_task(task_id, shard_ids)
+            if task is not None:
+                result.append(task)
+        return result
+
+
+class SnapshotTask:
+    iter_subtasks = Task.iter_subtasks
+    iter_prev_tasks = Task.iter_prev_tasks
+    iter_next_tasks = Task.iter_next_tasks
+    iter_sibling_tasks = Task.iter_sibling_tasks
+    iter_contexts = Task.iter_contexts
+    _check_status = Task._check_status
+    get_available_statuses = Task.get_available_statuses
+    get_next_statuses = Task.get_next_statuses
+    is_relevant = Task.is_relevant
+
+    def __init__(self, shard, idx):
+        self.shard = shard
+        (
+            id_offset, id_size, self._name_offset, self._name_size,
+            self._first_edge, self._subtask_count, self._parent_count,
+            status, flow, flags, self.priority, weight, progress, timestamp,
+        ) = RECORD.unpack_from(shard.buf, shard.records_offset + idx * RECORD.size)
+        self.id = shard.get_string(id_offset, id_size)
+        self.status = Status(status)
+        self.flow = Flow(flow)
+        self.aggregate = bool(flags & FLAG_AGGREGATE)
+        self.weight = None if flags & FLAG_NO_WEIGHT else weight
+        self.progress = None if math.isnan(progress) else progress
+        self.log = Log.__new__(Log)
+        self.log.items = [Log.Item(self.status, datetime.fromtimestamp(timestamp))]
+
+    def __repr__(self):
+        return f'SnapshotTask(name={self.name}, status={self.status})'
+
+    @cached_property
+    def name(self):
+        return self.shard.get_string(self._name_offset, self._name_size)
+
+    @cached_property
+    def subtasks(self):
+        # Subtasks of heads are in their own shard, the others are in the peers of the shard
+        shard_id = self.shard.shard_id
+        shard_ids = [self.id] if shard_id == ROOT_SHARD else self.shard.snapshot.peers[shard_id]
+        return self.shard.get_tasks(self._first_edge, self._subtask_count, shard_ids)
+
+    @cached_property
+    def parents(self):
+        if self.id == self.shard.snapshot.root_id:
+            return []
+        local = self.shard.get_tasks(self._first_edge + self._subtask_count, self._parent_count, [])
+        return local + self.shard.snapshot.get_external_parents(self, self.shard.shard_id)
+
+    def has_subtasks(self):
+        return self._subtask_count > 0
@@ -0,0 +1,634 @@
+from contextlib import contextmanager
+from datetime import timedelta
+from glob import glob
+from threading import Condition, Thread
+
+import dbm
+import fcntl
+import logging
+import os
+import shelve
+
+from orgmate.clock import Clock
+from orgmate.job import Job
+from orgmate.log import Log, FINISHED_TASK_TTL
+from orgmate.snapshot import ROOT_SHARD, get_shard_version, read_manifest, write_manifest, write_shard
+from orgmate.status import Status
+from orgmate.task import Task
+from orgmate.trie import Trie
+
+
+RECORD_FIELDS = (
+    'name', 'flow', 'note', 'aggregate', 'priority', 'weight', 'subtasks', 'log', 'rollups', 'jobs', 'progress',
+)
+NAME_FIELD = RECORD_FIELDS.index('name')
+SUBTASKS_FIELD = RECORD_FIELDS.index('subtasks')
+LOG_FIELD = RECORD_FIELDS.index('log')
+JOBS_FIELD = RECORD_FIELDS.index('jobs')
+PROGRESS_FIELD = RECORD_FIELDS.index('progress')
+CLAIM_TTL = timedelta(days=30)
+
+logger = logging.getLogger(__name__)
+
+
+def make_record(task):
+    subtask_ids = task.stub[0] if task.loader is not None else tuple(subtask.id for subtask in task.subtasks)
+    return (
+        task.name,
+        task.flow,
+        task.note,
+        task.aggregate,
+        task.priority,
+        task.weight,
+        subtask_ids,
+        tuple((item.status, item.timestamp) for item in task.log.items),
+        tuple((rollup.start, rollup.active, rollup.inactive) for rollup in task.log.rollups),
+        tuple((job.time, job.cmd, job.period) for job in task.jobs),
+        task.progress,
+    )
+
+
+def get_record(task):
+    if task.record is None:
+        task.record = make_record(task)
+    return task.record
+
+
+def collect_records(task, records=None):
+    if records is None:
+        records = {}
+    records[task.id] = get_record(task)
+    for subtask in task.subtasks:
+        if subtask.id not in records:
+            collect_records(subtask, records)
+    return records
+
+
+def _make_task(task_id, record):
+    name, flow, note, aggregate, priority, weight, _, log, rollups, jobs, _ = record
+    task = Task(name)
+    vars(task).update(id=task_id, flow=flow, note=note, _aggregate=aggregate, priority=priority, _weight=weight)
+    task.log.items = [Log.Item(*item) for item in log]
+    task.log.rollups = [Log.Rollup(*rollup) for rollup in rollups]
+    task.jobs = [Job(task, *job) for job in jobs]
+    task.record = record
+    return task
+
+
+def _merge_value(base, ours, theirs, what):
+    if ours == base:
+        return theirs
+    if theirs != base and theirs != ours:
+        logger.warning('Conflicting changes of %s, keeping local version', what)
+    return ours
+
+
+def _merge_sequence(base, ours, theirs, what):
+    if ours == base:
+        return theirs
+    if theirs == base:
+        return ours
+    base_items = set(base)
+    removed = (base_items - set(ours)) | (base_items - set(theirs))
+    merged = [item for item in theirs if item not in removed]
+    position = 0
+    for item in ours:
+        if item in merged:
+            position = merged.index(item) + 1
+        elif item not in base_items:
+            merged.insert(position, item)
+            position += 1
+    return tuple(merged)
+
+
+def _merge_log(base, ours, theirs, what):
+    if ours == base:
+        return theirs
+    if theirs == base:
+        return ours
+    removed = (set(base) - set(ours)) | (set(base) - set(theirs))
+    merged = []
+    for item in sorted(set(ours).union(theirs) - removed, key=lambda item: item[1]):
+        if not merged or merged[-1][0] != item[0]:
+            merged.append(item)
+    return tuple(merged) or ours
+
+
+def _merge_derived(base, ours, theirs, what):
+    return theirs if ours == base else ours
+
+
+FIELD_MERGERS = {
+    SUBTASKS_FIELD: _merge_sequence,
+    LOG_FIELD: _merge_log,
+    JOBS_FIELD: _merge_sequence,
+    PROGRESS_FIELD: _merge_derived,
+}
+
+
+def merge_records(base, ours, theirs):
+    merged = dict(theirs)
+    for task_id, record in ours.items():
+        base_record = base.get(task_id)
+        their_record = theirs.get(task_id)
+        if record == base_record:
+            continue
+        if base_record is None or their_record is None:
+            merged[task_id] = record
+            continue
+        merged[task_id] = tuple(
+            FIELD_MERGERS.get(idx, _merge_value)(b, o, t, f'{RECORD_FIELDS[idx]} of {record[NAME_FIELD]}')
+            for idx, (b, o, t) in enumerate(zip(base_record, record, their_record))
+        )
+    for task_id in base.keys() - ours.keys():
+        if theirs.get(task_id) == base[task_id]:
+            merged.pop(task_id, None)
+    return merged
+
+
+def drop_unreachable(root_id, shards):
+    records = {}
+    for shard_records in shards.values():
+        records.update(shard_records)
+    reachable, stack = set(), [root_id]
+    while stack:
+        task_id = stack.pop()
+        if task_id not in reachable and task_id in records:
+            reachable.add(task_id)
+            stack.extend(records[task_id][SUBTASKS_FIELD])
+    return {
+        shard_id: {task_id: record for task_id, record in shard_records.items() if task_id in reachable}
+        for shard_id, shard_records in shards.items()
+    }
+
+
+def _get_wake_time(records):
+    times = []
+    for record in records.values():
+        status, timestamp = record[LOG_FIELD][-1]
+        if status == Status.DONE:
+            times.append(timestamp + FINISHED_TASK_TTL)
+        times.extend(job[0] for job in record[JOBS_FIELD])
+    return min(times, default=None)
+
+
+def _make_snapshot_rows(records):
+    rows = []
+    for task_id, (name, flow, _, aggregate, priority, weight, subtask_ids, log, _, _, progress) in records.items():
+        status, timestamp = log[-1]
+        rows.append((task_id, name, status, flow, aggregate, priority, weight, progress, timestamp, subtask_ids))
+    return rows
+
+
+def _shard_key(shard_id):
+    return f'shard:{shard_id}'
+
+
+def _fsync(path):
+    for name in glob(f'{path}*'):
+        with open(name, 'rb') as f:
+            os.fsync(f.fileno())
+
+
+class Storage:
+    def __init__(self, path, snapshot_path):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.on_load = lambda tasks: None
+        # Main thread: loaded part of the graph, its shards and the shard index it was loaded from
+        self.root_id = None
+        self.tasks = {}
+        self.shards = {}
+        self.records = {}
+        self.peers = {}
+        self.changed = set()
+        self.deleted = set()
+        self.index = {}
+        self.loaded = set()
+        self.pending = {}
+        self.pending_names = Trie()
+        # Storage thread: the state last read from or written to disk
+        self.version = 0
+        self.base = {}
+        self.base_root_id = None
+        self.base_aliases = None
+        self.queued = None
+        self.failed = None
+        self.merged = None
+        self.busy = False
+        self.closed = False
+        self.condition = Condition()
+        self.worker = Thread(target=self._run, name='storage', daemon=True)
+        self.worker.start()
+
+    @contextmanager
+    def _lock(self, operation, path=None):
+        with open(f'{path or self.path}.lock', 'a') as f:
+            fcntl.flock(f, operation)
+            yield
+
+    @contextmanager
+    def _open(self, flag='r'):
+        try:
+            db = shelve.open(self.path, flag)
+        except dbm.error:
+            yield None
+            return
+        with db:
+            yield db
+
+    def _get_task(self, task_id, records):
+        task = self.tasks.get(task_id)
+        if task is None and task_id in records:
+            record = records[task_id]
+            task = self.tasks[task_id] = _make_task(task_id, record)
+            self._attach(task, record[SUBTASKS_FIELD], records)
+        return task
+
+    def _attach(self, task, subtask_ids, records):
+        for subtask_id in subtask_ids:
+            subtask = self._get_task(subtask_id, records)
+            if subtask is not None:
+                task._subtasks.append(subtask)
+                subtask.parents.append(task)
+
+    def _build(self, root_id, records, loaded):
+        self.root_id, self.tasks, self.pending, self.loaded = root_id, {}, {}, set(loaded)
+        self.pending_names = Trie()
+        record = records[root_id]
+        root = self.tasks[root_id] = _make_task(root_id, record)
+        heads = [head_id for head_id in record[SUBTASKS_FIELD] if head_id in records]
+        for head_id in heads:
+            head = self.tasks.get(head_id)
+            if head is None:
+                head = self.tasks[head_id] = _make_task(head_id, records[head_id])
+            root._subtasks.append(head)
+            head.parents.append(root)
+        for head_id in dict.fromkeys(heads):
+            head = self.tasks[head_id]
+            if head_id in loaded:
+                self._attach(head, records[head_id][SUBTASKS_FIELD], records)
+            else:
+                names = self.index[head_id][3] if head_id in self.index else ()
+                self.pending[head_id] = records[head_id][SUBTASKS_FIELD], names
+                for name in names:
+                    self.pending_names.add(name)
+                head.loader = self.load_shard
+                head.stub = records[head_id][SUBTASKS_FIELD], records[head_id][PROGRESS_FIELD]
+        self._reset(root)
+        return dict(self.tasks)
+
+    def _read_shards(self, db, shard_ids):
+        group, stack = {}, list(shard_ids)
+        while stack:
+            shard_id = stack.pop()
+            if shard_id in group or shard_id in self.loaded or shard_id not in self.index:
+                continue
+            group[shard_id] = db[_shard_key(shard_id)]
+            stack.extend(self.index[shard_id][1])
+        with self.condition:
+            for shard_id, records in group.items():
+                self.base[shard_id] = self.index[shard_id][0], records
+        return group
+
+    def _load_shards(self, shard_ids):
+        with self._lock(fcntl.LOCK_SH), self._open() as db:
+            self.index = db['shards']
+            group = self._read_shards(db, shard_ids)
+            # Heads keep the subtask ids they were loaded with, which are stale if another session changed them
+            root_version = self.base.get(ROOT_SHARD, (None,))[0]
+            heads = db[_shard_key(ROOT_SHARD)] if self.index[ROOT_SHARD][0] != root_version else {}
+        records = {}
+        for shard_records in group.values():
+            records.update(shard_records)
+        self.loaded.update(group)
+        known = set(self.tasks)
+        attached = set()
+        for shard_id in group.keys() | set(shard_ids):
+            head = self.tasks.get(shard_id)
+            if shard_id in self.pending and head is not None:
+                attached.add(shard_id)
+                head.loader = head.stub = None
+                head.__dict__.pop('progress', None)
+                subtask_ids, names = self.pending.pop(shard_id)
+                for name in names:
+                    self.pending_names.remove(name)
+                if shard_id in heads and heads[shard_id][SUBTASKS_FIELD] != subtask_ids:
+                    subtask_ids = heads[shard_id][SUBTASKS_FIELD]
+                    head.record = None
+                self._attach(head, subtask_ids, records)
+        if attached:
+            self.tasks[self.root_id].__dict__.pop('progress', None)
+        for shard_id in self._collect(self.tasks[self.root_id], group.keys() | attached):
+            if self.records[shard_id] != group.get(shard_id):
+                self.changed.add(shard_id)
+        self.on_load([task for task_id, task in self.tasks.items() if task_id not in known])
+
+    def load_shard(self, head):
+        logger.debug('Loading shard of %s', head.name)
+        self._load_shards([head.id])
+
+    def load_due(self, time):
+        due = [
+            shard_id for shard_id, (_, _, wake_time, _) in self.index.items()
+            if shard_id in self.pending and wake_time is not None and wake_time < time
+        ]
+        if due:
+            self._load_shards(due)
+
+    def load(self):
+        with self._lock(fcntl.LOCK_SH), self._open() as db:
+            if db is None:
+                return None
+            if 'shards' in db:
+                self.index = db['shards']
+                version, root_id, aliases = db['version'], db['root_id'], db['aliases']
+                records = db[_shard_key(ROOT_SHARD)]
+                self.base[ROOT_SHARD] = self.index[ROOT_SHARD][0], records
+                loaded = set()
+            elif 'root' in db:
+                root = db['root']
+                version, root_id, aliases, records = 0, root.id, db['aliases'], collect_records(root)
+                loaded = set(records)
+            else:
+                return None
+        self.version, self.base_root_id, self.base_aliases = version, root_id, dict(aliases)
+        tasks = self._build(root_id, records, loaded)
+        if version == 0:
+            self.changed = set(self.records)
+        return tasks, root_id, aliases
+
+    def claim(self, task_id, time, cmd):
+        # Every session sees the same due jobs, only the first one to claim a job runs it
+        key = task_id, time, cmd
+        with self._lock(fcntl.LOCK_EX), self._open('c') as db:
+            claims = db.get('claims', set())
+            if key in claims:
+                return False
+            cutoff = Clock.current.now() - CLAIM_TTL
+            db['claims'] = {claim for claim in claims if claim[1] >= cutoff} | {key}
+        return True
+
+    def _assign(self, task, shard_id):
+        self.tasks[task.id] = task
+        self.shards[task.id] = shard_id
+        self.records[shard_id][task.id] = get_record(task)
+
+    def _collect(self, root, shard_ids):
+        # Reassign the tasks of the given shards, the tasks of other shards stay where they are
+        for shard_id in shard_ids:
+            for task_id in self.records.pop(shard_id, ()):
+                del self.shards[task_id], self.tasks[task_id]
+        if ROOT_SHARD in shard_ids:
+            self.records[ROOT_SHARD] = {}
+            for task in (root, *root._subtasks):
+                self._assign(task, ROOT_SHARD)
+        for head in root._subtasks:
+            if head.id not in shard_ids or head.loader is not None or head.id in self.records:
+                continue
+            self.records[head.id] = {}
+            stack = head._subtasks[::-1]
+            while stack:
+                task = stack.pop()
+                if task.id not in self.shards:
+                    self._assign(task, head.id)
+                    stack.extend(reversed(task._subtasks))
+        walked = [shard_id for shard_id in shard_ids if shard_id in self.records]
+        for shard_id in walked:
+            self.peers[shard_id] = set()
+        for shard_id in walked:
+            for record in self.records[shard_id].values():
+                for subtask_id in record[SUBTASKS_FIELD]:
+                    peer_id = self.shards.get(subtask_id, shard_id)
+                    if peer_id == shard_id or ROOT_SHARD in (shard_id, peer_id):
+                        continue
+                    self.peers[shard_id].add(peer_id)
+                    if shard_id not in self.peers[peer_id]:
+                        self.peers[peer_id].add(shard_id)
+                        self.changed.add(peer_id)
+        for shard_id in self.peers.keys() - self.records.keys():
+            del self.peers[shard_id]
+        return walked
+
+    def _reset(self, root):
+        self.tasks, self.shards, self.records, self.peers = {}, {}, {}, {}
+        self._collect(root, {ROOT_SHARD, *(head.id for head in root._subtasks)})
+        self.changed = set()
+
+    def _update(self, root, dirty):
+        affected = set()
+        for task in dirty:
+            shard_id = self.shards.get(task.id)
+            if shard_id is None or self.tasks[task.id] is not task:
+                continue
+            old_record, record = self.records[shard_id][task.id], get_record(task)
+            if record == old_record:
+                continue
+            self.records[shard_id][task.id] = record
+            self.changed.add(shard_id)
+            old_subtask_ids, subtask_ids = old_record[SUBTASKS_FIELD], record[SUBTASKS_FIELD]
+            if subtask_ids == old_subtask_ids:
+                continue
+            if task is root:
+                affected.add(ROOT_SHARD)
+                affected.update(set(old_subtask_ids).symmetric_difference(subtask_ids))
+            else:
+                affected.add(task.id if shard_id == ROOT_SHARD else shard_id)
+        if affected:
+            # Tasks reachable from several shards may move between peers
+            affected.update(*[self.peers.get(shard_id, ()) for shard_id in affected])
+            old = {shard_id: (self.records.get(shard_id), self.peers.get(shard_id)) for shard_id in affected}
+            for shard_id in self._collect(root, affected):
+                if (self.records[shard_id], self.peers[shard_id]) != old[shard_id]:
+                    self.changed.add(shard_id)
+
+    def replace(self, root):
+        # New tasks are not dirty, so the next save rewrites all shards of the new graph
+        self.deleted |= (self.index.keys() | self.records.keys()) - {ROOT_SHARD}
+        self.root_id, self.index, self.pending, self.loaded = root.id, {}, {}, set()
+        self.pending_names = Trie()
+        Task.pop_dirty()
+        self._reset(root)
+        self.changed = set(self.records)
+
+    def save(self, root, aliases):
+        if root.id != self.root_id:
+            self.replace(root)
+        else:
+            heads = {head.id for head in root.subtasks}
+            deleted = set(self.index) - heads - self.loaded - {ROOT_SHARD}
+            linked = {shard_id for shard_id in deleted if self.index[shard_id][1]}
+            if linked:
+                self._load_shards(linked)
+                deleted -= self.loaded
+            self.deleted |= deleted
+            self._update(root, Task.pop_dirty())
+        deleted, self.deleted = self.deleted - self.records.keys(), set()
+        self.changed |= self.loaded - self.records.keys()
+        self.loaded = self.records.keys() - {ROOT_SHARD}
+        shards = {
+            shard_id: (dict(self.records.get(shard_id, {})), frozenset(self.peers.get(shard_id, ())))
+            for shard_id in self.changed
+        }
+        self.changed = set()
+        with self.condition:
+            # Only changed shards are queued, so keep the ones not written yet
+            queued_shards, queued_deleted = {}, set()
+            for queued in (self.failed, self.queued, (root.id, aliases, shards, deleted)):
+                if queued is not None and queued[0] == root.id:
+                    queued_shards.update(queued[2])
+                    queued_deleted = (queued_deleted - queued[2].keys()) | queued[3]
+            self.queued = root.id, dict(aliases), queued_shards, queued_deleted
+            self.failed = None
+            self.condition.notify_all()
+
+    def _write(self, root_id, aliases, shards, deleted):
+        adopted, written = {}, {}
+        ours = root_id, aliases
+        with self._lock(fcntl.LOCK_EX):
+            with self._open('c') as db:
+                index = db.get('shards', {})
+                version = db.get('version', 0)
+                if version != self.version:
+                    logger.info('Merging changes saved by another session')
+                    root_id = _merge_value(self.base_root_id, root_id, db['root_id'], 'root')
+                    aliases = _merge_value(self.base_aliases, aliases, db['aliases'], 'aliases')
+                version += 1
+                updates = {}
+                for shard_id, (records, peers) in shards.items():
+                    base_version, base_records = self.base.get(shard_id, (None, {}))
+                    if shard_id in index and index[shard_id][0] != base_version:
+                        their_version, their_peers, *_ = index[shard_id]
+                        their_records = db[_shard_key(shard_id)]
+                        adopted[shard_id] = records, merge_records(base_records, records, their_records)
+                        base_version, base_records = their_version, their_records
+                        peers = peers | their_peers
+                    updates[shard_id] = base_version, base_records, records, peers
+                if adopted:
+                    current = {shard_id: db[_shard_key(shard_id)] for shard_id in index.keys() - updates.keys()}
+                    current.update((shard_id, adopted[shard_id][1]) for shard_id in adopted)
+                    current.update((shard_id, update[2]) for shard_id, update in updates.items() if shard_id not in adopted)
+                    reachable = drop_unreachable(root_id, current)
+                    for shard_id, (records, merged) in adopted.items():
+                        adopted[shard_id] = records, reachable[shard_id]
+                        base_version, base_records, _, peers = updates[shard_id]
+                        updates[shard_id] = base_version, base_records, reachable[shard_id], peers
+                for shard_id, (base_version, base_records, records, peers) in updates.items():
+                    if records == base_records:
+                        self.base[shard_id] = base_version, base_records
+                        if shard_id in index and index[shard_id][1] != peers:
+                            index[shard_id] = index[shard_id][0], peers, *index[shard_id][2:]
+                    elif records:
+                        db[_shard_key(shard_id)] = records
+                        written[shard_id] = records
+                        names = tuple(record[NAME_FIELD] for record in records.values())
+                        index[shard_id] = version, peers, _get_wake_time(records), names
+                        self.base[shard_id] = version, records
+                    else:
+                        deleted.add(shard_id)
+                for shard_id in deleted:
+                    db.pop(_shard_key(shard_id), None)
+                    index.pop(shard_id, None)
+                    self.base.pop(shard_id, None)
+                db.pop('root', None)
+                db['shards'] = index
+                db['root_id'] = root_id
+                db['aliases'] = aliases
+                db['version'] = version
+            _fsync(self.path)
+        self.version, self.base_root_id, self.base_aliases = version, root_id, dict(aliases)
+        try:
+            self._write_snapshot(version, root_id, aliases, index, written)
+        except OSError:
+            logger.exception('Failed to write snapshot')
+        if adopted or (root_id, aliases) != ours:
+            return ours, (root_id, aliases), adopted, index
+        return None
+
+    def _write_snapshot(self, version, root_id, aliases, index, written):
+        # Sessions write their shards in any order, so only replace older versions
+        path = self.snapshot_path
+        with self._lock(fcntl.LOCK_EX, path):
+            try:
+                manifest_version = read_manifest(path)['version']
+            except (FileNotFoundError, NotADirectoryError, ValueError):
+                if os.path.isfile(path):
+                    os.remove(path)
+                os.makedirs(path, exist_ok=True)
+                with self._lock(fcntl.LOCK_SH), self._open() as db:
+                    index, version = db['shards'], db['version']
+                    root_id, aliases = db['root_id'], db['aliases']
+                    written = {shard_id: db[_shard_key(shard_id)] for shard_id in index}
+                manifest_version = -1
+            for shard_id, records in written.items():
+                shard_version = index[shard_id][0] if shard_id in index else None
+                if shard_version is not None and (get_shard_version(path, shard_id) or -1) < shard_version:
+                    write_shard(path, shard_id, shard_version, _make_snapshot_rows(records))
+            if manifest_version < version:
+                shards = {shard_id: sorted(peers) for shard_id, (_, peers, *_) in index.items()}
+                write_manifest(path, version, root_id, aliases, shards)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                self.condition.wait_for(lambda: self.closed or (self.queued is not None and self.merged is None))
+                if self.queued is None or self.merged is not None:
+                    return
+                snapshot, self.queued = self.queued, None
+                self.busy = True
+            failed = None
+            try:
+                merged = self._write(*snapshot)
+            except Exception:
+                logger.exception('Failed to save state')
+                merged, failed = None, snapshot
+            with self.condition:
+                self.busy = False
+                self.failed = failed
+                self.merged = merged
+                self.condition.notify_all()
+
+    def sync(self, root, aliases):
+        with self.condition:
+            if self.merged is None:
+                return None
+            (base_root_id, base_aliases), (their_root_id, their_aliases), adopted, self.index = self.merged
+            self.queued = None
+        root_id = _merge_value(base_root_id, root.id, their_root_id, 'root')
+        aliases = _merge_value(base_aliases, aliases, their_aliases, 'aliases')
+        base, theirs, ours = {}, {}, {}
+        for base_records, their_records in adopted.values():
+            base.update(base_records)
+            theirs.update(their_records)
+        self._update(root, Task.pop_dirty())
+        for records in self.records.values():
+            ours.update(records)
+        records = merge_records(base, ours, theirs)
+        loaded = set()
+        if root_id == root.id:
+            self.loaded = {head.id for head in root.subtasks if head.loader is None}
+            linked = set().union(*(self.index[shard_id][1] for shard_id in self.loaded if shard_id in self.index))
+            with self._lock(fcntl.LOCK_SH), self._open() as db:
+                group = self._read_shards(db, linked)
+            for shard_records in group.values():
+                for task_id, record in shard_records.items():
+                    records.setdefault(task_id, record)
+            loaded = self.loaded | group.keys()
+        tasks = self._build(root_id, records, loaded)
+        self.changed = set(self.records)
+        with self.condition:
+            self.merged = None
+            self.condition.notify_all()
+        self.save(tasks[root_id], aliases)
+        return tasks, root_id, aliases
+
+    def flush(self):
+        with self.condition:
+            self.condition.wait_for(lambda: self.merged is not None or (self.queued is None and not self.busy))
+
+    def close(self):
+        self.flush()
+        with self.condition:
+            self.closed = True
+            self.condition.notify_all()
+        self.worker.join()
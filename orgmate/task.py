@@ -1,9 +1,14 @@
 from enum import Enum, auto
 from functools import cached_property
+from heapq import heapify, heappush, heappop
+from uuid import uuid4
 
+from orgmate.clock import Clock
+from orgmate.history import History
 from orgmate.log import Log
 from orgmate.status import Status
 from orgmate.node import Node, NodeFilter
+from orgmate.trie import Trie
 
 
 class Flow(Enum):
@@ -26,10 +31,21 @@ def aggregate_status(subtasks):
 
 
 class Task:
+    RECORD_FIELDS = {'name', 'flow', 'note', 'priority'}
+    HISTORY_FIELDS = {'name', 'flow', 'note', 'priority', '_aggregate', '_weight'}
+    _expiry = []
+    _names = Trie()
+    _observers = []
+    _dirty = set()
+
     def __init__(self, name, context_mode=False):
+        self.record = None
+        self.id = uuid4().hex
         self.name = name
         self.parents = []
-        self.subtasks = []
+        self.loader = None
+        self.stub = None
+        self._subtasks = []
         self.log = Log()
         self.flow = Flow.SEQUENTIAL
         self.note = ''
@@ -48,8 +64,32 @@ class Task:
     def __getstate__(self):
         state = self.__dict__.copy()
         state.pop('progress', None)
+        state.pop('record', None)
         return state
 
+    def __setstate__(self, state):
+        state.setdefault('id', uuid4().hex)
+        state.setdefault('_subtasks', state.pop('subtasks', []))
+        state['record'] = None
+        state['loader'] = None
+        state['stub'] = None
+        self.__dict__.update(state)
+
+    def __setattr__(self, attr, value):
+        if attr == 'record' and value is None and self.__dict__.get('record') is not None:
+            self._dirty.add(self)
+        tracked = attr in self.HISTORY_FIELDS and attr in self.__dict__
+        if tracked:
+            History.record(self, setattr, self, attr, self.__dict__[attr])
+            if attr == 'name' and self.parents:
+                self._names.remove(self.name)
+                self._names.add(value)
+        super().__setattr__(attr, value)
+        if attr in self.RECORD_FIELDS:
+            self.record = None
+        if tracked:
+            self._notify()
+
     def iter_prev_tasks(self):
         for parent in self.parents:
             if parent.flow != Flow.SEQUENTIAL:
@@ -142,17 +182,37 @@ class Task:
 
     def add(self, subtask, index=None):
         if index is None:
-            self.subtasks.append(subtask)
+            self.link(subtask, len(self.subtasks), len(subtask.parents))
             index = len(self.subtasks)
         else:
-            self.subtasks.insert(index, subtask)
-        subtask.parents.append(self)
+            self.link(subtask, index, len(subtask.parents))
         subtask.name = subtask.name.format(index)
         self.refresh()
 
+    def link(self, subtask, index, parent_index):
+        self.subtasks.insert(index, subtask)
+        subtask.parents.insert(parent_index, self)
+        if len(subtask.parents) == 1:
+            self._update_names(subtask, self._names.add)
+        History.record(self, self.unlink, subtask, index, parent_index)
+        self._notify(True)
+
+    def unlink(self, subtask, index, parent_index):
+        # Keep the whole subtree in memory, so that undo can bring it back
+        if subtask.loader is not None:
+            subtask.loader(subtask)
+        del self.subtasks[index]
+        del subtask.parents[parent_index]
+        if not subtask.parents:
+            self._update_names(subtask, self._names.remove)
+        History.record(self, self.link, subtask, index, parent_index)
+        self._notify(True)
+
     def iter_subtasks(self, node_filter=None, depth=None):
         if node_filter is None:
             node_filter = NodeFilter()
+        if not node_filter.check_depth(depth):
+            return
         for task in self.subtasks:
             node = Node(self, task, depth)
             if node_filter.check(node):
@@ -163,6 +223,18 @@ class Task:
     def is_relevant(self):
         return self.priority > 0 and self.get_next_statuses()
 
+    @property
+    def subtasks(self):
+        if self.loader is not None:
+            self.loader(self)
+        return self._subtasks
+
+    def has_subtasks(self):
+        # Heads of unloaded shards keep the ids of their subtasks and their progress
+        if self.loader is not None:
+            return bool(self.stub[0])
+        return bool(self._subtasks)
+
     @property
     def status(self):
         return self.log.get_status()
@@ -171,7 +243,7 @@ class Task:
     def status(self, value):
         if self.aggregate and self.subtasks:
             return
-        self.log.set_status(value)
+        self._set_status(value)
         self.refresh()
 
     @property
@@ -198,6 +270,8 @@ class Task:
             return 1.0
         if not self.aggregate:
             return None
+        if self.loader is not None:
+            return self.stub[1]
         result, weight_sum = 0, 0
         for task in self.subtasks:
             progress = task.progress
@@ -208,10 +282,11 @@ class Task:
         return result / weight_sum if weight_sum > 0 else 0
 
     def refresh(self):
+        self.record = None
         if self.aggregate and self.subtasks:
-            self.log.set_status(aggregate_status(self.subtasks))
-        if hasattr(self, 'progress'):
-            del self.progress
+            self._set_status(aggregate_status(self.subtasks))
+        self.__dict__.pop('progress', None)
+        self._notify()
         for task in self.parents:
             task.refresh()
 
@@ -221,10 +296,80 @@ class Task:
             return getattr(self, name)(value)
         return True
 
-    def clear_obsolete(self):
-        for task in list(self.subtasks):
-            if task.log.is_obsolete():
-                self.subtasks.remove(task)
-            else:
-                task.clear_obsolete()
-        self.refresh()
+    def _set_status(self, status):
+        if not self.log.set_status(status):
+            return
+        History.touch(self)
+        self._notify(True)
+        if status == Status.DONE:
+            heappush(self._expiry, (self.log.get_expiry_time(), self.id, self))
+
+    def _notify(self, reshaped=False):
+        for observer in self._observers:
+            observer(self, reshaped)
+
+    @classmethod
+    def observe(cls, observer):
+        cls._observers.append(observer)
+
+    @classmethod
+    def unobserve(cls, observer):
+        cls._observers.remove(observer)
+
+    @classmethod
+    def pop_dirty(cls):
+        result, cls._dirty = cls._dirty, set()
+        return result
+
+    @classmethod
+    def init_expiry(cls, tasks):
+        cls._expiry.clear()
+        cls.extend_expiry(tasks)
+
+    @classmethod
+    def extend_expiry(cls, tasks):
+        for task in tasks:
+            expiry_time = task.log.get_expiry_time()
+            if expiry_time is not None:
+                cls._expiry.append((expiry_time, task.id, task))
+        heapify(cls._expiry)
+
+    @classmethod
+    def clear_obsolete(cls):
+        now = Clock.current.now()
+        while cls._expiry and cls._expiry[0][0] < now:
+            expiry_time, _, task = heappop(cls._expiry)
+            if task.log.get_expiry_time() != expiry_time:
+                continue
+            with History.transaction(automatic=True):
+                while task.parents:
+                    parent = task.parents[-1]
+                    parent.unlink(task, parent.subtasks.index(task), len(task.parents) - 1)
+                    parent.refresh()
+
+    @classmethod
+    def init_names(cls, tasks):
+        cls._names = Trie()
+        cls.extend_names(tasks)
+
+    @classmethod
+    def extend_names(cls, tasks):
+        for task in set(tasks):
+            if task.parents:
+                cls._names.add(task.name)
+
+    @classmethod
+    def _update_names(cls, task, update):
+        # Walks the tasks that are reachable only through the given one
+        visited, stack = {task}, [task]
+        while stack:
+            task = stack.pop()
+            update(task.name)
+            for subtask in task._subtasks:
+                if subtask not in visited and all(parent in visited for parent in subtask.parents):
+                    visited.add(subtask)
+                    stack.append(subtask)
+
+    @classmethod
+    def iter_names(cls, prefix):
+        return cls._names.iter_keys(prefix)
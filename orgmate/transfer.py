@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+import json
+
+from orgmate.job import Job
+from orgmate.log import Log
+from orgmate.status import Status
+from orgmate.task import Flow, Task, aggregate_status
+
+
+def iter_records(task, seen=None):
+    if seen is None:
+        seen = set()
+    seen.add(task.id)
+    yield {
+        'type': 'task',
+        'id': task.id,
+        'name': task.name,
+        'flow': task.flow.name,
+        'aggregate': task.aggregate,
+        'priority': task.priority,
+        'weight': task.weight,
+        'note': task.note,
+    }
+    for rollup in task.log.rollups:
+        yield {
+            'type': 'rollup',
+            'task': task.id,
+            'start': rollup.start.isoformat(),
+            'active': rollup.active.total_seconds(),
+            'inactive': rollup.inactive.total_seconds(),
+        }
+    for item in task.log.items:
+        yield {'type': 'log', 'task': task.id, 'status': item.status.name, 'timestamp': item.timestamp.isoformat()}
+    for job in task.jobs:
+        period = job.period.total_seconds() if job.period else None
+        yield {'type': 'job', 'task': task.id, 'time': job.time.isoformat(), 'cmd': job.cmd, 'period': period}
+    for subtask in task.subtasks:
+        if subtask.id not in seen:
+            yield from iter_records(subtask, seen)
+        yield {'type': 'edge', 'parent': task.id, 'child': subtask.id}
+
+
+def build_graph(records):
+    tasks = {}
+    root = None
+    for record in records:
+        match record['type']:
+            case 'task':
+                task = Task(record['name'])
+                task.id = record['id']
+                task.flow = Flow[record['flow']]
+                task.priority = record['priority']
+                task.note = record['note']
+                task._aggregate = record['aggregate']
+                task._weight = record['weight']
+                task.log.items.clear()
+                tasks[task.id] = task
+                root = root or task
+            case 'log':
+                timestamp = datetime.fromisoformat(record['timestamp'])
+                tasks[record['task']].log.items.append(Log.Item(Status[record['status']], timestamp))
+            case 'rollup':
+                start = datetime.fromisoformat(record['start'])
+                active, inactive = timedelta(seconds=record['active']), timedelta(seconds=record['inactive'])
+                tasks[record['task']].log.rollups.append(Log.Rollup(start, active, inactive))
+            case 'job':
+                period = timedelta(seconds=record['period']) if record['period'] is not None else None
+                task = tasks[record['task']]
+                task.jobs.append(Job(task, datetime.fromisoformat(record['time']), record['cmd'], period))
+            case 'edge':
+                if record['parent'] not in tasks or record['child'] not in tasks:
+                    raise ValueError(f'edge between unknown tasks {record["parent"]} and {record["child"]}')
+                parent, child = tasks[record['parent']], tasks[record['child']]
+                parent.subtasks.append(child)
+                child.parents.append(parent)
+    if root is None:
+        raise ValueError('no tasks found')
+    for task in tasks.values():
+        if not task.log.items:
+            raise ValueError(f'no log items for task {task.id}')
+    _refresh_statuses(root, set())
+    return root
+
+
+def _refresh_statuses(task, seen):
+    seen.add(task)
+    for subtask in task.subtasks:
+        if subtask not in seen:
+            _refresh_statuses(subtask, seen)
+    if task.aggregate and task.subtasks:
+        task.log.set_status(aggregate_status(task.subtasks))
+
+
+def export_jsonl(task, file):
+    for record in iter_records(task):
+        file.write(json.dumps(record) + '\n')
+
+
+def import_jsonl(file):
+    return build_graph(json.loads(line) for line in file if line.strip())
@@ -0,0 +1,42 @@
+from bisect import bisect_left, insort
+
+
+class Trie:
+    # Keys are kept sorted with a count per key, so prefix scans start with a binary search
+    def __init__(self, keys=()):
+        self.counts = {}
+        for key in keys:
+            self.counts[key] = self.counts.get(key, 0) + 1
+        self.keys = sorted(self.counts)
+
+    def __contains__(self, key):
+        return key in self.counts
+
+    def add(self, key):
+        count = self.counts.get(key, 0)
+        if not count:
+            insort(self.keys, key)
+        self.counts[key] = count + 1
+
+    def remove(self, key):
+        count = self.counts.get(key)
+        if count is None:
+            return
+        if count > 1:
+            self.counts[key] = count - 1
+            return
+        del self.counts[key]
+        del self.keys[bisect_left(self.keys, key)]
+
+    def iter_keys(self, prefix=''):
+        for idx in range(bisect_left(self.keys, prefix), len(self.keys)):
+            key = self.keys[idx]
+            if not key.startswith(prefix):
+                return
+            yield key
+
+    def longest_prefix(self, text):
+        for idx in range(len(text), -1, -1):
+            if text[:idx] in self.counts:
+                return text[:idx]
+        return None
@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from orgmate.clock import Clock
+from orgmate.history import History
+from orgmate.job import Job
+from orgmate.log import FINISHED_TASK_TTL
+from orgmate.node import Node
+from orgmate.status import Status
+from orgmate.task import Task
+
+
+START_TIME = datetime(2024, 1, 1)
+
+
+@pytest.fixture(autouse=True)
+def clock():
+    saved = Clock.current
+    Clock.current = Clock(START_TIME)
+    Job.init_schedule([])
+    Task.init_expiry([])
+    History.clear()
+    yield Clock.current
+    Clock.current = saved
+
+
+def get_names(task):
+    return [subtask.name for subtask in task.subtasks]
+
+
+def test_undo_and_redo_commands():
+    root = Task('user')
+    with History.transaction():
+        root.add(Task('first'))
+        root.add(Task('second'))
+    first, second = root.subtasks
+    with History.transaction():
+        first.status = Status.ACTIVE
+    with History.transaction():
+        Node(root, second).remove()
+    assert History.undo()
+    assert get_names(root) == ['first', 'second']
+    assert History.undo()
+    assert first.status == root.status == Status.NEW
+    assert History.undo()
+    assert get_names(root) == []
+    assert not History.undo()
+    assert History.redo()
+    assert History.redo()
+    assert get_names(root) == ['first', 'second']
+    assert first.status == root.status == Status.ACTIVE
+    with History.transaction():
+        first.name = 'renamed'
+    assert not History.redo()
+    assert History.undo()
+    assert first.name == 'first'
+
+
+def test_undo_and_redo_jobs(clock):
+    task = Task('task')
+    with History.transaction():
+        Job(task, START_TIME + timedelta(hours=1), 'once', None).add()
+    assert History.undo()
+    assert task.jobs == []
+    with clock.at(START_TIME + timedelta(hours=2)):
+        assert list(Job.iter_pending()) == []
+    assert History.redo()
+    job, = task.jobs
+    with clock.at(START_TIME + timedelta(hours=2)):
+        assert list(Job.iter_pending()) == [job]
+    assert task.jobs == []
+
+
+def test_expiry_is_undone_with_previous_command(clock):
+    root = Task('user')
+    root.add(Task('first'))
+    first, = root.subtasks
+    with History.transaction():
+        first.status = Status.DONE
+    clock.advance(FINISHED_TASK_TTL + timedelta(seconds=1))
+    Task.clear_obsolete()
+    assert get_names(root) == []
+    assert History.undo()
+    assert get_names(root) == ['first']
+    assert first.status == Status.NEW
+    # Redo brings back the command and the expiry that followed it
+    assert History.redo()
+    assert get_names(root) == []
+    assert not History.redo()
+
+
+def test_only_automatic_entries_are_not_undone(clock):
+    root = Task('user')
+    root.add(Task('first'))
+    first, = root.subtasks
+    first.status = Status.DONE
+    clock.advance(FINISHED_TASK_TTL + timedelta(seconds=1))
+    Task.clear_obsolete()
+    assert not History.undo()
+    assert get_names(root) == []
@@ -0,0 +1,60 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from orgmate.clock import Clock
+from orgmate.history import History
+from orgmate.job import Job
+from orgmate.task import Task
+
+
+START_TIME = datetime(2024, 1, 1)
+
+
+@pytest.fixture(autouse=True)
+def clock():
+    saved = Clock.current
+    Clock.current = Clock(START_TIME)
+    Job.init_schedule([])
+    History.clear()
+    yield Clock.current
+    Clock.current = saved
+
+
+def run_pending():
+    return [(job.cmd, job.time) for job in Job.iter_pending()]
+
+
+def test_periodic_job(clock):
+    task = Task('task')
+    Job(task, START_TIME + timedelta(hours=9), 'daily', timedelta(days=1)).add()
+    with clock.at(START_TIME + timedelta(days=1, hours=10)):
+        assert run_pending() == [
+            ('daily', START_TIME + timedelta(hours=9)),
+            ('daily', START_TIME + timedelta(days=1, hours=9)),
+        ]
+    assert Job.get_next_time() == START_TIME + timedelta(days=2, hours=9)
+
+
+def test_removed_job_does_not_run(clock):
+    task = Task('task')
+    job = Job(task, START_TIME + timedelta(hours=9), 'once', None)
+    job.add()
+    job.remove()
+    with clock.at(START_TIME + timedelta(hours=10)):
+        assert run_pending() == []
+
+
+def test_undo_and_redo_keep_schedule_order(clock):
+    first, second = Task('first'), Task('second')
+    with History.transaction():
+        Job(first, START_TIME + timedelta(hours=9), 'daily', timedelta(days=1)).add()
+    History.undo()
+    History.redo()
+    Job(second, START_TIME + timedelta(hours=10), 'once', None).add()
+    with clock.at(START_TIME + timedelta(hours=10, minutes=30)):
+        assert run_pending() == [
+            ('daily', START_TIME + timedelta(hours=9)),
+            ('once', START_TIME + timedelta(hours=10)),
+        ]
+    assert len(Job._schedule) == 1
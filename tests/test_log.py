@@ -0,0 +1,86 @@
+from dataclasses import replace
+from datetime import datetime, timedelta
+
+import pytest
+
+from orgmate.clock import Clock
+from orgmate.history import History
+from orgmate.log import Log, MONTHLY_ROLLUP_AGE, WEEKLY_ROLLUP_AGE
+from orgmate.status import Status
+
+
+NOW = datetime(2024, 6, 1)
+
+
+@pytest.fixture(autouse=True)
+def clock():
+    saved = Clock.current
+    Clock.current = Clock(NOW)
+    History.clear()
+    yield Clock.current
+    Clock.current = saved
+
+
+def make_log(*items):
+    log = Log()
+    log.items = [Log.Item(status, timestamp) for status, timestamp in items]
+    return log
+
+
+def get_totals(log):
+    return log.get_total_time(Status.ACTIVE), log.get_total_time(Status.INACTIVE)
+
+
+def test_roll_up_splits_periods():
+    log = make_log(
+        (Status.ACTIVE, datetime(2024, 5, 1, 22)),
+        (Status.INACTIVE, datetime(2024, 5, 2, 2)),
+        (Status.ACTIVE, datetime(2024, 5, 2, 3)),
+    )
+    log.compact(datetime(2024, 5, 2, 3))
+    assert log.rollups == [
+        Log.Rollup(datetime(2024, 5, 1), timedelta(hours=2)),
+        Log.Rollup(datetime(2024, 5, 2), timedelta(hours=2), timedelta(hours=1)),
+    ]
+    assert log.items == [Log.Item(Status.ACTIVE, datetime(2024, 5, 2, 3))]
+
+
+def test_compact_keeps_totals_across_coarse_periods():
+    items, timestamp = [], datetime(2022, 1, 1)
+    while timestamp < NOW - timedelta(days=10):
+        items.append((Status.ACTIVE, timestamp))
+        items.append((Status.INACTIVE, timestamp + timedelta(hours=29)))
+        timestamp += timedelta(hours=36)
+    log = make_log(*items)
+    totals = get_totals(log)
+    cutoff = NOW - timedelta(days=30)
+    log.compact(cutoff)
+    assert get_totals(log) == totals
+    assert log.items[0].timestamp >= cutoff - timedelta(hours=36)
+    starts = [rollup.start for rollup in log.rollups]
+    assert starts == sorted(set(starts))
+    for start in starts:
+        if cutoff - start >= MONTHLY_ROLLUP_AGE:
+            assert start.day == 1 and start.time() == datetime.min.time()
+        elif cutoff - start >= WEEKLY_ROLLUP_AGE:
+            assert start.weekday() == 0 and start.time() == datetime.min.time()
+    # Compacting again only merges periods that became old enough
+    log.compact(cutoff + timedelta(days=60))
+    assert get_totals(log) == totals
+
+
+def test_undo_compaction(clock):
+    log = make_log(
+        (Status.ACTIVE, NOW - timedelta(days=40)),
+        (Status.INACTIVE, NOW - timedelta(days=35)),
+    )
+    items, rollups = list(log.items), [replace(rollup) for rollup in log.rollups]
+    with History.transaction():
+        log.set_status(Status.ACTIVE)
+    assert log.items == [Log.Item(Status.ACTIVE, NOW)]
+    assert get_totals(log) == (timedelta(days=5), timedelta(days=35))
+    assert History.undo()
+    assert log.items == items
+    assert log.rollups == rollups
+    assert History.redo()
+    assert log.items == [Log.Item(Status.ACTIVE, NOW)]
@@ -0,0 +1,252 @@
+from datetime import datetime, timedelta
+
+import pytest
+import random
+
+from orgmate.clock import Clock
+from orgmate.node import Node, NodeFilter
+from orgmate.snapshot import Snapshot
+from orgmate.status import Status
+from orgmate.storage import Storage, merge_records
+from orgmate.task import Task
+from orgmate.transfer import build_graph, iter_records
+
+
+START_TIME = datetime(2024, 1, 1)
+
+
+@pytest.fixture(autouse=True)
+def clock():
+    saved = Clock.current
+    Clock.current = Clock(START_TIME)
+    yield Clock.current
+    Clock.current = saved
+
+
+class Session:
+    def __init__(self, path):
+        self.storage = Storage(str(path / 'data'), str(path / 'snapshot'))
+        state = self.storage.load()
+        if state is None:
+            self.root = Task('user')
+        else:
+            tasks, root_id, _ = state
+            self.root = tasks[root_id]
+
+    def find(self, *names):
+        task = self.root
+        for name in names:
+            task = next(subtask for subtask in task.subtasks if subtask.name == name)
+        return task
+
+    def save(self):
+        self.storage.save(self.root, {})
+        self.storage.flush()
+        state = self.storage.sync(self.root, {})
+        if state is not None:
+            tasks, root_id, _ = state
+            self.root = tasks[root_id]
+            self.storage.flush()
+
+    def close(self):
+        self.storage.close()
+
+
+def remove(parent, name):
+    task = next(subtask for subtask in parent.subtasks if subtask.name == name)
+    Node(parent, task).remove()
+
+
+def get_names(task):
+    return [subtask.name for subtask in task.subtasks]
+
+
+def init(tmp_path):
+    session = Session(tmp_path)
+    project = Task('project')
+    session.root.add(project)
+    project.add(Task('first'))
+    project.add(Task('second'))
+    session.save()
+    session.close()
+
+
+@pytest.fixture
+def sessions(tmp_path):
+    init(tmp_path)
+    result = Session(tmp_path), Session(tmp_path)
+    for session in result:
+        session.find('project', 'first')
+    yield result
+    for session in result:
+        session.close()
+
+
+def load(tmp_path):
+    session = Session(tmp_path)
+    session.close()
+    return session
+
+
+def test_concurrent_top_level_adds(tmp_path, sessions):
+    ours, theirs = sessions
+    theirs.root.add(Task('from theirs'))
+    theirs.save()
+    ours.root.add(Task('from ours'))
+    ours.save()
+    assert sorted(get_names(ours.root)) == ['from ours', 'from theirs', 'project']
+    assert sorted(get_names(load(tmp_path).root)) == ['from ours', 'from theirs', 'project']
+
+
+def test_concurrent_subtask_adds(tmp_path, sessions):
+    ours, theirs = sessions
+    theirs.find('project').add(Task('from theirs'))
+    theirs.save()
+    ours.find('project').add(Task('from ours'))
+    ours.save()
+    expected = ['first', 'second', 'from ours', 'from theirs']
+    assert get_names(ours.find('project')) == expected
+    assert get_names(load(tmp_path).find('project')) == expected
+
+
+def test_remove_and_status_change(tmp_path, sessions):
+    ours, theirs = sessions
+    remove(theirs.find('project'), 'second')
+    theirs.save()
+    ours.find('project', 'first').status = Status.ACTIVE
+    ours.save()
+    session = load(tmp_path)
+    assert get_names(session.find('project')) == ['first']
+    assert session.find('project', 'first').status == Status.ACTIVE
+
+
+def test_remove_changed_task(tmp_path, sessions):
+    ours, theirs = sessions
+    theirs.find('project', 'second').status = Status.ACTIVE
+    theirs.save()
+    remove(ours.find('project'), 'second')
+    ours.save()
+    assert get_names(load(tmp_path).find('project')) == ['first']
+    records = ours.storage.base[ours.root.subtasks[0].id][1]
+    assert sorted(record[0] for record in records.values()) == ['first']
+
+
+def test_concurrent_status_changes(tmp_path, sessions, clock):
+    ours, theirs = sessions
+    first = ours.find('project', 'first')
+    with clock.at(START_TIME + timedelta(hours=2)):
+        theirs.find('project', 'first').status = Status.DONE
+        theirs.find('project', 'second').status = Status.ACTIVE
+        theirs.save()
+    with clock.at(START_TIME + timedelta(hours=1)):
+        first.status = Status.ACTIVE
+        ours.save()
+    session = load(tmp_path)
+    first = session.find('project', 'first')
+    assert [item.status for item in first.log.items] == [Status.NEW, Status.ACTIVE, Status.DONE]
+    assert first.status == Status.DONE
+    assert session.find('project', 'second').status == Status.ACTIVE
+
+
+def test_load_shard_changed_by_other_session(tmp_path):
+    init(tmp_path)
+    ours, theirs = Session(tmp_path), Session(tmp_path)
+    theirs.find('project').add(Task('from theirs'))
+    theirs.save()
+    ours.find('project').add(Task('from ours'))
+    ours.save()
+    ours.close()
+    theirs.close()
+    assert get_names(load(tmp_path).find('project')) == ['first', 'second', 'from theirs', 'from ours']
+
+
+def test_snapshot_keeps_merged_shards(tmp_path, sessions):
+    ours, theirs = sessions
+    theirs.find('project').add(Task('from theirs'))
+    theirs.save()
+    ours.find('project', 'first').status = Status.ACTIVE
+    ours.save()
+    snapshot = Snapshot(str(tmp_path / 'snapshot'))
+    project, = snapshot.root.subtasks
+    assert get_names(project) == ['first', 'second', 'from theirs']
+    assert project.subtasks[0].status == Status.ACTIVE
+    assert project.subtasks[0].parents == [project]
+    snapshot.close()
+
+
+def test_depth_limited_walk_keeps_shards_unloaded(tmp_path):
+    init(tmp_path)
+    session = Session(tmp_path)
+    nodes = list(session.root.iter_subtasks(NodeFilter(max_depth=1), 0))
+    assert [(node.task.name, node.task.has_subtasks(), node.progress) for node in nodes] == [('project', True, '0.00%')]
+    assert not session.storage.loaded
+    session.close()
+
+
+def test_replace_with_same_root(tmp_path):
+    init(tmp_path)
+    session = Session(tmp_path)
+    records = list(iter_records(session.root))
+    session.find('project', 'first').status = Status.ACTIVE
+    session.root.add(Task('extra'))
+    session.save()
+    session.root = build_graph(records)
+    session.storage.replace(session.root)
+    session.save()
+    session.close()
+    session = load(tmp_path)
+    assert get_names(session.root) == ['project']
+    assert session.find('project', 'first').status == Status.NEW
+
+
+def test_jobs_are_claimed_once(tmp_path):
+    init(tmp_path)
+    ours, theirs = Session(tmp_path), Session(tmp_path)
+    time = START_TIME + timedelta(hours=1)
+    assert ours.storage.claim('task', time, 'add standup')
+    assert not theirs.storage.claim('task', time, 'add standup')
+    assert theirs.storage.claim('task', time + timedelta(days=1), 'add standup')
+    ours.close()
+    theirs.close()
+
+
+def dump(task):
+    return task.name, task.status, [dump(subtask) for subtask in task.subtasks]
+
+
+def iter_tasks(task):
+    yield task
+    for subtask in task.subtasks:
+        yield from iter_tasks(subtask)
+
+
+def test_saves_keep_moved_tasks(tmp_path):
+    rng = random.Random(0)
+    session = Session(tmp_path)
+    for idx in range(200):
+        tasks = list(dict.fromkeys(iter_tasks(session.root)))
+        task = rng.choice(tasks)
+        parent = rng.choice(task.parents) if task.parents else None
+        target = rng.choice([t for t in tasks if t not in set(iter_tasks(task))] or [session.root])
+        match rng.randrange(5):
+            case 0 | 1:
+                target.add(Task(f'task {idx}'))
+            case 2 if parent is not None:
+                Node(parent, task).remove()
+                if rng.randrange(2):
+                    target.add(task)
+            case 3 if parent is not None and task not in target.subtasks:
+                target.add(task)
+            case _:
+                task.status = Status.ACTIVE
+        if rng.randrange(4) == 0:
+            session.save()
+    session.save()
+    session.close()
+    assert dump(load(tmp_path).root) == dump(session.root)
+
+
+def test_merge_records_drops_deleted():
+    record = ('task',)
+    assert merge_records({'a': record}, {}, {'a': record}) == {}
+    assert merge_records({'a': record}, {'a': record}, {}) == {}
@@ -0,0 +1,82 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from orgmate.clock import Clock
+from orgmate.history import History
+from orgmate.log import FINISHED_TASK_TTL
+from orgmate.status import Status
+from orgmate.task import Task
+
+
+START_TIME = datetime(2024, 1, 1)
+
+
+@pytest.fixture(autouse=True)
+def clock():
+    saved = Clock.current
+    Clock.current = Clock(START_TIME)
+    Task.init_expiry([])
+    History.clear()
+    yield Clock.current
+    Clock.current = saved
+
+
+def make_tree(*names):
+    root = Task('user')
+    for name in names:
+        root.add(Task(name))
+    return root, *root.subtasks
+
+
+def test_done_tasks_expire(clock):
+    root, first, second = make_tree('first', 'second')
+    first.status = Status.DONE
+    clock.advance(FINISHED_TASK_TTL)
+    Task.clear_obsolete()
+    assert root.subtasks == [first, second]
+    clock.advance(timedelta(seconds=1))
+    Task.clear_obsolete()
+    assert root.subtasks == [second]
+    assert first.parents == []
+
+
+def test_expiry_unlinks_all_parents(clock):
+    root, first, second = make_tree('first', 'second')
+    shared = Task('shared')
+    first.add(shared)
+    second.add(shared)
+    shared.status = Status.DONE
+    clock.advance(FINISHED_TASK_TTL + timedelta(seconds=1))
+    Task.clear_obsolete()
+    assert first.subtasks == second.subtasks == []
+    assert shared.parents == []
+
+
+def test_reopened_tasks_skip_stale_entries(clock):
+    root, first = make_tree('first')
+    first.status = Status.DONE
+    clock.advance(timedelta(days=1))
+    first.status = Status.ACTIVE
+    clock.advance(timedelta(days=1))
+    first.status = Status.DONE
+    done_time = clock.now()
+    clock.advance(FINISHED_TASK_TTL - timedelta(days=1))
+    Task.clear_obsolete()
+    assert root.subtasks == [first]
+    with clock.at(done_time + FINISHED_TASK_TTL + timedelta(seconds=1)):
+        Task.clear_obsolete()
+    assert root.subtasks == []
+    assert len(Task._expiry) == 0
+
+
+def test_expiry_can_be_undone(clock):
+    root, first, second = make_tree('first', 'second')
+    with History.transaction():
+        first.status = Status.DONE
+    clock.advance(FINISHED_TASK_TTL + timedelta(seconds=1))
+    Task.clear_obsolete()
+    assert root.subtasks == [second]
+    assert History.undo()
+    assert root.subtasks == [first, second]
+    assert first.status == Status.NEW
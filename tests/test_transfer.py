@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+import io
+import pytest
+
+from orgmate.clock import Clock
+from orgmate.job import Job
+from orgmate.log import Log
+from orgmate.status import Status
+from orgmate.task import Task
+from orgmate.transfer import build_graph, export_jsonl, import_jsonl, iter_records
+
+
+START_TIME = datetime(2024, 1, 1)
+
+
+@pytest.fixture(autouse=True)
+def clock():
+    saved = Clock.current
+    Clock.current = Clock(START_TIME)
+    yield Clock.current
+    Clock.current = saved
+
+
+def dump(task):
+    return (
+        task.id, task.name, task.flow, task.aggregate, task.priority, task.weight, task.note,
+        [(item.status, item.timestamp) for item in task.log.items],
+        [(rollup.start, rollup.active, rollup.inactive) for rollup in task.log.rollups],
+        [(job.time, job.cmd, job.period) for job in task.jobs],
+        [dump(subtask) for subtask in task.subtasks],
+    )
+
+
+def test_round_trip(clock):
+    root, project, other, shared = Task('user'), Task('project'), Task('other', context_mode=True), Task('shared')
+    root.add(project)
+    root.add(other)
+    project.add(shared)
+    other.add(shared)
+    with clock.at(START_TIME + timedelta(hours=1)):
+        shared.status = Status.ACTIVE
+    project.log.rollups.append(Log.Rollup(datetime(2023, 1, 1), timedelta(hours=1), timedelta(hours=2)))
+    shared.jobs.append(Job(shared, datetime(2024, 1, 2, 9), 'set status done', timedelta(days=1)))
+    other.note = 'note\n'
+    file = io.StringIO()
+    export_jsonl(root, file)
+    file.seek(0)
+    result = import_jsonl(file)
+    assert dump(result) == dump(root)
+    project, other = result.subtasks
+    assert project.subtasks[0] is other.subtasks[0]
+    assert project.subtasks[0].parents == [project, other]
+    assert project.subtasks[0].jobs[0].task is project.subtasks[0]
+
+
+def test_rejects_task_without_log():
+    records = [record for record in iter_records(Task('user')) if record['type'] != 'log']
+    with pytest.raises(ValueError):
+        build_graph(records)
+
+
+def test_rejects_edge_to_unknown_task():
+    root, task = Task('user'), Task('task')
+    root.add(task)
+    records = [record for record in iter_records(root) if task.id not in (record.get('id'), record.get('task'))]
+    with pytest.raises(ValueError):
+        build_graph(records)
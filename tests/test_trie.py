@@ -0,0 +1,31 @@
+from orgmate.trie import Trie
+
+
+def test_iter_keys():
+    trie = Trie(['write report', 'write', 'read', 'wrap', 'write'])
+    assert list(trie.iter_keys('wr')) == ['wrap', 'write', 'write report']
+    assert list(trie.iter_keys('write ')) == ['write report']
+    assert list(trie.iter_keys('x')) == []
+    assert list(trie.iter_keys()) == ['read', 'wrap', 'write', 'write report']
+
+
+def test_remove_counts_duplicates():
+    trie = Trie(['task', 'task', 'tasks'])
+    trie.remove('task')
+    assert 'task' in trie
+    trie.remove('task')
+    assert 'task' not in trie
+    trie.remove('task')
+    trie.remove('missing')
+    assert list(trie.iter_keys('ta')) == ['tasks']
+    trie.add('task')
+    assert list(trie.iter_keys('ta')) == ['task', 'tasks']
+
+
+def test_longest_prefix():
+    trie = Trie(['ls', 'l', 'todo'])
+    assert trie.longest_prefix('ls -a') == 'ls'
+    assert trie.longest_prefix('lx') == 'l'
+    assert trie.longest_prefix('do') is None
+    trie.add('')
+    assert trie.longest_prefix('do') == ''